@@ -1,13 +1,45 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
+from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
+from django.forms.models import BaseInlineFormSet
 from vkontakte_api.admin import VkontakteModelAdmin
 
 from .models import Album, Video
+from .utils import get_approximate_count
+
+
+class ApproximateCountPaginator(Paginator):
+
+    '''
+    Paginator of huge tables, which takes count of unfiltered rows from statistics of DB
+    '''
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = get_approximate_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class LimitedInlineFormSet(BaseInlineFormSet):
+
+    '''
+    Inline formset with only `limit` first objects
+    '''
+    limit = 100
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            self._queryset = super(LimitedInlineFormSet, self).get_queryset()[:self.limit]
+        return self._queryset
 
 
 class VideoInline(admin.TabularInline):
 
+    def queryset(self, request):
+        return super(VideoInline, self).queryset(request).prefetch_related('owner')
+
     def image(self, instance):
         return '<img src="%s" />' % (instance.photo_130,)
     image.short_description = 'video'
@@ -18,6 +50,8 @@ class VideoInline(admin.TabularInline):
     readonly_fields = fields
     extra = False
     can_delete = False
+    formset = LimitedInlineFormSet
+    ordering = ('-date',)
 
 
 class AlbumAdmin(VkontakteModelAdmin):
@@ -27,6 +61,9 @@ class AlbumAdmin(VkontakteModelAdmin):
     image_preview.short_description = u'Картинка'
     image_preview.allow_tags = True
 
+    def queryset(self, request):
+        return super(AlbumAdmin, self).queryset(request).prefetch_related('owner')
+
     list_display = ('image_preview', 'remote_id', 'title', 'owner', 'videos_count')
     list_display_links = ('title', 'remote_id',)
     search_fields = ('title', 'description')
@@ -40,9 +77,14 @@ class VideoAdmin(VkontakteModelAdmin):
     image_preview.short_description = u'Картинка'
     image_preview.allow_tags = True
 
+    def queryset(self, request):
+        # album is nullable, so it isn't followed by list_select_related = True
+        return super(VideoAdmin, self).queryset(request).select_related('album').prefetch_related('owner')
+
     list_display = ('image_preview', 'remote_id', 'owner', 'album', 'title', 'comments_count', 'views_count', 'date')
     list_display_links = ('remote_id', 'title')
     list_filter = ('album',)
+    paginator = ApproximateCountPaginator
 
 
 admin.site.register(Album, AlbumAdmin)
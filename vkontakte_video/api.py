@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from vkontakte_api.api import VkontakteApi
+
+__all__ = ['api_call']
+
+local = threading.local()
+
+
+def api_call(*args, **kwargs):
+    '''
+    The same as vkontakte_api.api.api_call(), but with own instance of VkontakteApi in every thread.
+    VkontakteApi is a singleton, keeping method and token of the current call in attributes,
+    so it can't be shared between threads
+    '''
+    api = getattr(local, 'api', None)
+    if api is None:
+        api = local.api = VkontakteApi.__new__(VkontakteApi)
+        api.__init__()
+    return api.call(*args, **kwargs)
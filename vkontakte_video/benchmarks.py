@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+import resource
+import threading
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from vkontakte_groups.models import Group
+
+from .models import Album, Video, VideoRemoteManager, VideoSyncState
+from .testing import FakeVkontakteApi
+from .utils import QueriesCounter
+
+# remote id of group, which owns synthetic videos
+BENCHMARK_GROUP_ID = 999999999
+
+
+class PhasesTimer(object):
+
+    '''
+    Context manager, measuring time and number of rows of phases of saving fetched videos:
+    parse - parsing of responses into instances,
+    diff - comparing instances with existing rows (only with `bulk`),
+    save - writing rows (it includes diff without `bulk`)
+    '''
+    methods = (
+        ('parse', 'parse_response'),
+        ('diff', 'diff_instances'),
+        ('save', 'save_instances'),
+        ('save', 'get_or_create_from_instance'),
+    )
+
+    def __init__(self):
+        self.time = defaultdict(float)
+        self.rows = defaultdict(int)
+        self.originals = {}
+
+    def __enter__(self):
+        for phase, name in self.methods:
+            # methods, inherited from mixins, are not in __dict__ and should be deleted after the block
+            self.originals[name] = VideoRemoteManager.__dict__.get(name)
+            setattr(VideoRemoteManager, name, self.wrap(phase, getattr(VideoRemoteManager, name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self.originals.items():
+            if original is None:
+                delattr(VideoRemoteManager, name)
+            else:
+                setattr(VideoRemoteManager, name, original)
+        self.originals = {}
+
+    def wrap(self, phase, method):
+        def wrapper(manager, *args, **kwargs):
+            start = time.time()
+            result = method(manager, *args, **kwargs)
+            self.time[phase] += time.time() - start
+            if phase == 'parse':
+                self.rows[phase] += len(result) if isinstance(result, list) else 1
+            elif phase == 'diff':
+                self.rows[phase] += len(args[0])
+            elif len(args) == 3:
+                self.rows[phase] += sum([len(instances) for instances in args])
+            else:
+                self.rows[phase] += 1
+            return result
+        return wrapper
+
+    def rows_per_second(self, phase):
+        return self.rows[phase] / self.time[phase] if self.time[phase] else 0.
+
+
+def get_memory():
+    '''
+    Resident memory of the current process in megabytes: the current one from /proc on Linux,
+    the peak one of the whole process in other systems
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024. / 1024.
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class MemorySampler(object):
+
+    '''
+    Context manager, sampling resident memory in background thread every `interval` seconds.
+    `peak` is the peak growth of memory during the block in megabytes, so passes are measured separately.
+    Without /proc it's the growth of the peak memory of the process, which is 0, if the block used less
+    memory than the code before it
+    '''
+    interval = 0.01
+
+    def __enter__(self):
+        self.start = self.max = get_memory()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        self.max = max(self.max, get_memory())
+
+    @property
+    def peak(self):
+        return self.max - self.start
+
+
+def get_fake_api(size, albums=10):
+    '''
+    Return FakeVkontakteApi with `size` synthetic videos of one group, distributed between `albums` albums
+    '''
+    api = FakeVkontakteApi()
+    for album_id in range(1, albums + 1):
+        api.add_album(-BENCHMARK_GROUP_ID, album_id)
+    for video_id in range(1, size + 1):
+        api.add_video(-BENCHMARK_GROUP_ID, video_id, album_id=video_id % albums + 1)
+    return api
+
+
+def measure(api, owner, bulk=False, scenario='owner'):
+    timer = PhasesTimer()
+    start = time.time()
+
+    with api.patch(), timer, QueriesCounter() as queries, MemorySampler() as memory:
+        if scenario == 'albums':
+            for album in Album.remote.fetch(owner=owner, all=True):
+                album.fetch_videos(all=True, bulk=bulk)
+        else:
+            Video.remote.fetch(owner=owner, all=True, bulk=bulk)
+
+    duration = time.time() - start
+    videos = Video.objects.filter(owner_id=owner.pk).count()
+
+    return {
+        'videos': videos,
+        'time': duration,
+        'videos_per_second': videos / duration if duration else 0.,
+        'queries_per_video': float(queries.count) / videos if videos else 0.,
+        'requests': len(api.calls),
+        'peak_memory': memory.peak,
+        'parse': timer.rows_per_second('parse'),
+        'diff': timer.rows_per_second('diff'),
+        'save': timer.rows_per_second('save'),
+    }
+
+
+def delete_benchmark_data(owner, created=False):
+    '''
+    Delete synthetic albums and videos of benchmark group and the group itself, if it was `created`
+    '''
+    lookup = {'owner_content_type': ContentType.objects.get_for_model(owner), 'owner_id': owner.pk}
+    Video.objects.filter(**lookup).delete()
+    VideoSyncState.objects.filter(**lookup).delete()
+    Album.objects.filter(**lookup).delete()
+    if created:
+        owner.delete()
+
+
+def run_benchmark(size, albums=10, bulk=False, scenario='owner'):
+    '''
+    Fetch `size` synthetic videos through the real managers twice: into empty DB and over existing rows.
+    Returns list of results of both passes. All synthetic rows are deleted afterwards: fetch methods commit
+    their own transactions in Django < 1.6, so the benchmark can't be wrapped into one transaction and rolled back
+    '''
+    api = get_fake_api(size, albums)
+    owner, created = Group.objects.get_or_create(remote_id=BENCHMARK_GROUP_ID)
+    results = []
+    try:
+        for name in ['initial', 'resync']:
+            api.calls = []
+            result = measure(api, owner, bulk=bulk, scenario=scenario)
+            result.update({'size': size, 'pass': name, 'mode': 'bulk' if bulk else 'row'})
+            results += [result]
+    finally:
+        delete_benchmark_data(owner, created)
+
+    return results
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+# parameters of API methods, which define the response
+KEY_PARAMS = ('owner_id', 'album_id', 'offset', 'count', 'videos', 'extended', 'v')
+
+
+class ResponseCache(object):
+
+    '''
+    Base cache of API responses with expiration after `timeout` seconds and
+    eviction of least recently used responses, when there are more than `max_entries` of them.
+    Responses are kept serialized, so every get() returns new copy of response.
+    Counters `hits` and `misses` are available for monitoring
+    '''
+
+    def __init__(self, timeout=3600, max_entries=1000, clock=time.time):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
+
+    def make_key(self, method, params):
+        params = sorted([(name, params[name]) for name in KEY_PARAMS if name in params])
+        return '%s:%s' % (method, json.dumps(params))
+
+    def get(self, key):
+        with self.lock:
+            value = self.get_value(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, response):
+        value = json.dumps(response)
+        with self.lock:
+            self.set_value(key, value)
+
+    def get_value(self, key):
+        raise NotImplementedError()
+
+    def set_value(self, key, value):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+
+class MemoryResponseCache(ResponseCache):
+
+    '''
+    Cache of API responses in memory of the current process
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(MemoryResponseCache, self).__init__(*args, **kwargs)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_value(self, key):
+        try:
+            expires, value = self.entries.pop(key)
+        except KeyError:
+            return None
+
+        if expires < self.clock():
+            return None
+
+        # move to the end as the most recently used
+        self.entries[key] = (expires, value)
+        return value
+
+    def set_value(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock() + self.timeout, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SqliteResponseCache(ResponseCache):
+
+    '''
+    Cache of API responses in sqlite database file `path`, which survives restarts of process
+    '''
+
+    def __init__(self, path, *args, **kwargs):
+        super(SqliteResponseCache, self).__init__(*args, **kwargs)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                '(key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def get_value(self, key):
+        now = self.clock()
+        row = self.connection.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        value, expires = row
+        if expires < now:
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.connection.commit()
+            return None
+
+        self.connection.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+        self.connection.commit()
+        return value
+
+    def set_value(self, key, value):
+        now = self.clock()
+        self.connection.execute('INSERT OR REPLACE INTO responses (key, value, expires, used) VALUES (?, ?, ?, ?)',
+                                (key, value, now + self.timeout, now))
+        self.connection.execute('DELETE FROM responses WHERE key IN '
+                                '(SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM responses')
+        self.connection.commit()
+
+
+response_cache = None
+
+
+def get_response_cache():
+    '''
+    Return default cache of API responses, defined by setting VKONTAKTE_VIDEO_RESPONSE_CACHE:
+
+        VKONTAKTE_VIDEO_RESPONSE_CACHE = {
+            'PATH': '/var/cache/vkontakte_video.sqlite',  # without PATH responses are cached in memory
+            'TIMEOUT': 3600,
+            'MAX_ENTRIES': 10000,
+        }
+
+    Returns None, if setting is not defined
+    '''
+    global response_cache
+    config = getattr(settings, 'VKONTAKTE_VIDEO_RESPONSE_CACHE', None)
+    if config and response_cache is None:
+        kwargs = {'timeout': config.get('TIMEOUT', 3600), 'max_entries': config.get('MAX_ENTRIES', 1000)}
+        if config.get('PATH'):
+            response_cache = SqliteResponseCache(config['PATH'], **kwargs)
+        else:
+            response_cache = MemoryResponseCache(**kwargs)
+    return response_cache
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from datetime import date, datetime
+from itertools import chain
+import csv
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from .models import Album, Video
+
+__all__ = ['AlbumRecord', 'VideoRecord', 'iter_albums', 'iter_videos', 'iter_records', 'export', 'FORMATS']
+
+ALBUM_FIELDS = ('remote_id', 'owner_id', 'title', 'videos_count', 'updated', 'fetched')
+VIDEO_FIELDS = ('remote_id', 'owner_id', 'album_id', 'title', 'duration', 'views_count', 'likes_count',
+                'comments_count', 'date', 'archived', 'fetched')
+
+
+class Record(object):
+
+    '''
+    Read-only record of row, built from values_list() without instantiating of model.
+    Fields are `fields` of model and `owner_remote_id` - id of owner with sign, the same as in API
+    '''
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.remote_id)
+
+    @property
+    def url(self):
+        return 'http://vk.com/%s' % self.slug
+
+    def as_dict(self, fields):
+        return dict([(name, getattr(self, name)) for name in fields])
+
+
+class AlbumRecord(Record):
+    fields = ALBUM_FIELDS
+    __slots__ = ALBUM_FIELDS + ('owner_remote_id',)
+
+    @property
+    def slug(self):
+        return 'videos%s?section=album_%s' % (self.owner_remote_id, self.remote_id)
+
+
+class VideoRecord(Record):
+    fields = VIDEO_FIELDS
+    __slots__ = VIDEO_FIELDS + ('owner_remote_id',)
+
+    @property
+    def slug(self):
+        return 'video%s_%s' % (self.owner_remote_id, self.remote_id)
+
+
+class OwnersRemoteIds(object):
+
+    '''
+    Map (owner_content_type_id, owner_id) of rows to signed remote ids of owners, loading them by chunks
+    '''
+
+    def __init__(self):
+        self.models = {-1: Group, 1: User}
+        self.signs = dict([(ContentType.objects.get_for_model(Model).pk, sign) for sign, Model in self.models.items()])
+        self.remote_ids = {}
+
+    def load(self, owners):
+        missing = set([owner for owner in owners if owner not in self.remote_ids])
+        for content_type_id, sign in self.signs.items():
+            pks = [owner_id for ct_id, owner_id in missing if ct_id == content_type_id]
+            if pks:
+                for pk, remote_id in self.models[sign].objects.filter(pk__in=pks).values_list('pk', 'remote_id'):
+                    self.remote_ids[(content_type_id, pk)] = sign * remote_id
+
+    def get(self, content_type_id, owner_id):
+        return self.remote_ids.get((content_type_id, owner_id))
+
+
+def iter_records(queryset, record_class, chunk_size=1000):
+    '''
+    Generator of `record_class` records of every row of queryset. Rows are selected by chunks of `chunk_size` ordered by pk,
+    every chunk starts after the last pk of previous one, so memory usage is bounded by the size of chunk
+    and doesn't depend on cursors of DB backend
+    '''
+    owners = OwnersRemoteIds()
+    fields = record_class.fields
+    queryset = queryset.order_by('pk').values_list('owner_content_type_id', *fields)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            break
+
+        owners.load([(row[0], row[fields.index('owner_id') + 1]) for row in rows])
+        for row in rows:
+            record = record_class(*row[1:])
+            record.owner_remote_id = owners.get(row[0], record.owner_id)
+            yield record
+
+        last_pk = rows[-1][fields.index('remote_id') + 1]
+
+
+def iter_albums(queryset=None, chunk_size=1000):
+    return iter_records(Album.objects.all() if queryset is None else queryset, AlbumRecord, chunk_size)
+
+
+def iter_videos(queryset=None, chunk_size=1000):
+    return iter_records(Video.objects.all() if queryset is None else queryset, VideoRecord, chunk_size)
+
+
+def serialize(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(records, file, fields, chunk_size):
+    writer = csv.writer(file)
+    writer.writerow(fields)
+    for record in records:
+        writer.writerow([unicode(serialize(getattr(record, name))).encode('utf-8')
+                         if getattr(record, name) is not None else '' for name in fields])
+
+
+def write_jsonl(records, file, fields, chunk_size):
+    for record in records:
+        values = record.as_dict(fields)
+        file.write(json.dumps(dict([(name, serialize(value)) for name, value in values.items()])) + '\n')
+
+
+def write_columns(records, file, fields, chunk_size):
+    '''
+    Write columnar chunks: one JSON object per line with list of values of every field for `chunk_size` records
+    '''
+    def write(columns):
+        file.write(json.dumps(dict(zip(fields, columns))) + '\n')
+
+    columns = [[] for name in fields]
+    for record in records:
+        for column, name in zip(columns, fields):
+            column.append(serialize(getattr(record, name)))
+        if len(columns[0]) >= chunk_size:
+            write(columns)
+            columns = [[] for name in fields]
+    if columns[0]:
+        write(columns)
+
+
+FORMATS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'columns': write_columns,
+}
+
+
+def export(records, file, format='csv', fields=None, chunk_size=1000):
+    '''
+    Write records from iter_albums() or iter_videos() to `file` in `format`: csv, jsonl (JSON Lines) or columns.
+    By default fields are all fields of records and `owner_remote_id`, `slug` and `url`.
+    Nothing is written without records
+    '''
+    records = iter(records)
+    try:
+        first = next(records)
+    except StopIteration:
+        return
+
+    fields = fields or first.fields + ('owner_remote_id', 'slug', 'url')
+    FORMATS[format](chain([first], records), file, fields, chunk_size)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import cProfile
+import json
+import logging
+import pstats
+import threading
+import time
+
+from django.conf import settings
+
+from .signals import vkontakte_video_fetch_stats
+from .utils import QueriesCounter
+
+__all__ = ['FetchStats', 'get_stats', 'phase', 'instrumented']
+
+log = logging.getLogger('vkontakte_video.stats')
+
+local = threading.local()
+
+
+class FetchStats(object):
+
+    '''
+    Statistics of one call of fetch() of remote manager:
+     * `phases` - seconds spent in phases: request (HTTP and JSON decoding), parse, owner (resolution of owners), save;
+     * `pages` - number of API requests, `cached_pages` - number of responses taken from response cache;
+     * `bytes` - size of received responses in serialized JSON;
+     * `queries` - number of SQL queries;
+     * `profile` - pstats.Stats of the call, if setting VKONTAKTE_VIDEO_FETCH_PROFILE is True.
+    Phases could be nested: time of `owner` is also included in `parse`, time of `parse` in `request` is not.
+    Time of pages, requested in parallel, is summed over threads
+    '''
+
+    def __init__(self, name, owner_id=None):
+        self.name = name
+        self.owner_id = owner_id
+        self.phases = defaultdict(float)
+        self.pages = 0
+        self.cached_pages = 0
+        self.bytes = 0
+        self.queries = 0
+        self.time = 0.
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def add_response(self, response, owner_id=None, cached=False):
+        size = len(json.dumps(response))
+        with self.lock:
+            if cached:
+                self.cached_pages += 1
+            else:
+                self.pages += 1
+                self.bytes += size
+            if self.owner_id is None:
+                self.owner_id = owner_id
+
+    def as_dict(self):
+        return {
+            'fetch': self.name,
+            'owner_id': self.owner_id,
+            'time': round(self.time, 6),
+            'phases': dict([(name, round(seconds, 6)) for name, seconds in self.phases.items()]),
+            'pages': self.pages,
+            'cached_pages': self.cached_pages,
+            'bytes': self.bytes,
+            'queries': self.queries,
+        }
+
+
+def get_stats():
+    '''
+    Return statistics of the current fetch in this thread or None outside of instrumented fetch
+    '''
+    return getattr(local, 'stats', None)
+
+
+@contextmanager
+def use_stats(stats):
+    '''
+    Collect statistics of the current thread into `stats`. It's used by pools of threads, requesting pages
+    '''
+    previous = get_stats()
+    local.stats = stats
+    try:
+        yield stats
+    finally:
+        local.stats = previous
+
+
+@contextmanager
+def phase(name):
+    '''
+    Add time of the block to phase `name` of the current fetch. Does nothing outside of instrumented fetch
+    '''
+    stats = get_stats()
+    if stats is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.time() - start)
+
+
+def instrumented(method):
+    '''
+    Decorator of fetch() method of remote manager, collecting FetchStats of the call, if setting
+    VKONTAKTE_VIDEO_FETCH_STATS is True. After the call statistics are sent with signal
+    vkontakte_video_fetch_stats and logged as one JSON line to logger `vkontakte_video.stats`.
+    Nested fetches are accounted in the statistics of the outer one
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if get_stats() is not None or not getattr(settings, 'VKONTAKTE_VIDEO_FETCH_STATS', False):
+            return method(self, *args, **kwargs)
+
+        stats = FetchStats('%s.%s' % (self.model.__name__, method.__name__))
+        profile = cProfile.Profile() if getattr(settings, 'VKONTAKTE_VIDEO_FETCH_PROFILE', False) else None
+        start = time.time()
+
+        with use_stats(stats), QueriesCounter() as queries:
+            try:
+                if profile:
+                    result = profile.runcall(method, self, *args, **kwargs)
+                else:
+                    result = method(self, *args, **kwargs)
+            finally:
+                stats.time = time.time() - start
+
+        stats.queries = queries.count
+        if profile:
+            stats.profile = pstats.Stats(profile)
+
+        vkontakte_video_fetch_stats.send(sender=self.model, stats=stats)
+        log.info(json.dumps(stats.as_dict(), sort_keys=True))
+        return result
+
+    return wrapper
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from vkontakte_video.benchmarks import run_benchmark
+
+COLUMNS = (
+    ('size', '%8d'),
+    ('mode', '%5s'),
+    ('scenario', '%7s'),
+    ('pass', '%8s'),
+    ('time', '%9.2f'),
+    ('videos_per_second', '%9.1f'),
+    ('queries_per_video', '%8.2f'),
+    ('requests', '%8d'),
+    ('peak_memory', '%8.1f'),
+    ('parse', '%9.1f'),
+    ('diff', '%9.1f'),
+    ('save', '%9.1f'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark of fetching videos through the real managers from fake API with synthetic responses. ' \
+           'Columns: wall time in seconds, videos per second, SQL queries per video, API requests, ' \
+           'peak growth of memory during the pass in MB and rows per second of phases parse, diff and save'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='1000,10000,100000', help='Comma separated numbers of videos'),
+        make_option('--albums', type='int', default=100, help='Number of albums'),
+        make_option('--modes', default='row,bulk', help='Comma separated modes of saving: row, bulk'),
+        make_option('--scenario', default='owner', choices=['owner', 'albums'],
+                    help='Fetch videos of owner at once or album by album'),
+    )
+
+    def handle(self, **options):
+        self.stdout.write(' '.join([name for name, format in COLUMNS]))
+
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            for mode in options['modes'].split(','):
+                for result in run_benchmark(size, albums=options['albums'], bulk=(mode == 'bulk'),
+                                            scenario=options['scenario']):
+                    result['scenario'] = options['scenario']
+                    self.stdout.write(' '.join([format % result[name] for name, format in COLUMNS]))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vkontakte_video.models import OwnerSchedule
+from vkontakte_video.sync import sync_owners, run_schedule, SYNC_MODES, REQUESTS_PER_SECOND
+from vkontakte_video.utils import TokenBucket, owner_cache
+
+
+class Command(BaseCommand):
+    args = '<owner_id owner_id ...>'
+    help = 'Synchronize albums and videos of owners, defined by ids: positive for users and negative for groups ' \
+           '(put -- before negative ids in command line). Progress is printed to stderr after every owner, ' \
+           'summary is printed to stdout as JSON. Exits with error, if synchronization of any owner failed. ' \
+           'With --schedule owners are added to the schedule and owners are synchronized, when they are due. ' \
+           'Many scheduling processes could run on many hosts, owners are leased to one of them'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--file', help='File with ids of owners, one per line'),
+        make_option('--workers', type='int', default=1, help='Number of owners, synchronized concurrently'),
+        make_option('--mode', choices=SYNC_MODES,
+                    help='Synchronize all videos (full), only new videos (incremental) or only albums (albums). '
+                         'Default is full, with --schedule it is incremental'),
+        make_option('--rate', type='float', default=REQUESTS_PER_SECOND, help='Maximum API requests per second'),
+        make_option('--bulk', action='store_true', default=False, help='Save every page of videos at once'),
+        make_option('--schedule', action='store_true', default=False,
+                    help='Run scheduler, synchronizing due owners of the schedule until it is interrupted'),
+        make_option('--once', action='store_true', default=False,
+                    help='With --schedule synchronize only owners, which are due now, and exit'),
+        make_option('--worker', help='With --schedule name of worker, holding leases of owners, host:pid by default'),
+        make_option('--lease', type='int', default=600,
+                    help='With --schedule seconds of lease of owners, after which owners of died worker are reclaimed'),
+    )
+
+    def handle(self, *args, **options):
+        ids = list(args)
+        if options.get('file'):
+            with open(options['file']) as f:
+                ids += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        if not ids and not options['schedule']:
+            raise CommandError('Specify ids of owners in arguments or in file')
+
+        try:
+            owners = [owner_cache.get(int(id)) for id in ids]
+        except ValueError as e:
+            raise CommandError('Wrong id of owner: %s' % e)
+
+        mode = options['mode'] or ('incremental' if options['schedule'] else 'full')
+        kwargs = {'mode': mode}
+        if mode != 'albums' and options['bulk']:
+            kwargs['bulk'] = True
+
+        if options['schedule']:
+            for owner in owners:
+                OwnerSchedule.objects.add(owner)
+            self.total = None
+            report = run_schedule(workers=options['workers'], rate_limiter=TokenBucket(options['rate']),
+                                  progress=self.progress, once=options['once'], worker=options['worker'],
+                                  lease=options['lease'], **kwargs)
+        else:
+            self.total = len(owners)
+            report = sync_owners(owners, workers=options['workers'], rate_limiter=TokenBucket(options['rate']),
+                                 progress=self.progress, **kwargs)
+
+        summary = report.as_dict()
+        summary['mode'] = mode
+        self.stdout.write(json.dumps(summary, sort_keys=True))
+
+        if report.failed:
+            raise CommandError('Synchronization of %d owners failed' % len(report.failed))
+
+    def progress(self, report):
+        result = report.results[-1]
+        done = len(report)
+        if self.total:
+            eta = ', ETA %ds' % (report.duration / done * (self.total - done))
+        else:
+            eta = ''
+        self.stderr.write('[%d/%s] %s: %d albums, %d videos in %.1fs%s | %.1f videos/s, %.1f requests/s%s' % (
+            done, self.total or '-', result.owner, result.albums, result.videos, result.duration,
+            '' if result.success else ', error %r' % result.error,
+            report.videos / report.duration if report.duration else 0.,
+            report.requests / report.duration if report.duration else 0., eta))
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import logging
+import re
+
+from django.db import connection, models
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from vkontakte_api.decorators import atomic
+from vkontakte_api.mixins import ActionableModelMixin
+from vkontakte_api.models import VkontakteManager, VkontakteTimelineManager, MASTER_DATABASE
+from vkontakte_api.signals import vkontakte_api_post_fetch
+
+from .api import api_call
+from .cache import get_response_cache
+from .instrumentation import get_stats, phase, use_stats
+
+log = logging.getLogger('vkontakte_video')
+
+
+class ApiManagerMixin(VkontakteManager):
+
+    '''
+    Manager, which makes all remote calls through api_response().
+    Every fetch method accepts arguments:
+     * `rate_limiter` - object with method acquire(), called before each request,
+       for example utils.TokenBucket shared between threads;
+     * `parallel_pages` - number of concurrent requests for pages after the first one.
+       The first response reveals `count` of all items, so all the rest pages are requested
+       in pool of threads and returned with the first page in one response. It's useful with `all=True`;
+     * `response_cache` - cache.ResponseCache for responses of methods `cached_methods`.
+       By default it's defined by setting VKONTAKTE_VIDEO_RESPONSE_CACHE, without it nothing is cached.
+    Items of responses of methods, defined in `response_fields` (full name of method -> fields),
+    keep only these fields, see trim_response()
+    '''
+    cached_methods = ('get',)
+    response_fields = {}
+
+    def api_call(self, *args, **kwargs):
+        response = self.api_response(*args, **kwargs)
+        if isinstance(response, dict) and 'items' in response:
+            response = response['items']
+        return response
+
+    def api_response(self, method='get', methods_namespace=None, rate_limiter=None, parallel_pages=None,
+                     response_cache=None, **kwargs):
+        '''
+        The same as VkontakteManager.api_call(), but returns the whole response with `count` of all items
+        '''
+        if method in self.cached_methods:
+            if response_cache is None:
+                response_cache = get_response_cache()
+        else:
+            response_cache = None
+
+        if self.model.methods_access_tag:
+            kwargs['methods_access_tag'] = self.model.methods_access_tag
+
+        version = self.version
+
+        if method in self.methods:
+            method = self.methods[method]
+
+        if isinstance(method, tuple):
+            method, version = method
+
+        version = kwargs.pop('v', version)
+        if version:
+            kwargs['v'] = float(version)
+
+        # empty string means method without namespace, like `execute`
+        if methods_namespace is None:
+            methods_namespace = self.methods_namespace
+        if methods_namespace:
+            method = methods_namespace + '.' + method
+
+        response = self.request(method, rate_limiter, response_cache, **kwargs)
+
+        if parallel_pages and isinstance(response, dict) and response.get('items') and 'count' in response:
+            response = self.request_pages(response, method, parallel_pages, rate_limiter, response_cache, **kwargs)
+
+        return response
+
+    def api_responses(self, calls, workers=1, **kwargs):
+        '''
+        Call api_response() with kwargs of every item of `calls` and common `kwargs` in pool of `workers` threads.
+        Returns list of responses in the order of calls
+        '''
+        stats = get_stats()
+
+        def call(call_kwargs):
+            with use_stats(stats):
+                return self.api_response(**dict(kwargs, **call_kwargs))
+
+        if workers <= 1 or len(calls) <= 1:
+            return [call(call_kwargs) for call_kwargs in calls]
+
+        pool = ThreadPool(min(workers, len(calls)))
+        try:
+            return pool.map(call, calls)
+        finally:
+            pool.close()
+            pool.join()
+
+    def request(self, method, rate_limiter=None, response_cache=None, **kwargs):
+        stats = get_stats()
+
+        if response_cache is not None:
+            key = response_cache.make_key(method, kwargs)
+            response = response_cache.get(key)
+            if response is not None:
+                if stats:
+                    stats.add_response(response, kwargs.get('owner_id'), cached=True)
+                return response
+
+        if rate_limiter:
+            rate_limiter.acquire()
+        with phase('request'):
+            response = api_call(method, **kwargs)
+        if stats:
+            stats.add_response(response, kwargs.get('owner_id'))
+        if method in self.response_fields:
+            response = self.trim_response(response, self.response_fields[method])
+
+        if response_cache is not None:
+            response_cache.set(key, response)
+        return response
+
+    def trim_response(self, response, fields):
+        '''
+        Keep only `fields` in every item of response with `items` (or of every such response in list
+        of responses of method `execute`) and drop all the rest keys except `count`, like `profiles` and `groups`
+        of extended responses. Only trimmed responses are cached and kept in memory till all pages are parsed
+        '''
+        if isinstance(response, list):
+            return [self.trim_response(item, fields) for item in response]
+        if isinstance(response, dict) and 'items' in response:
+            trimmed = {'items': [dict([(field, item[field]) for field in fields if field in item])
+                                 if isinstance(item, dict) else item for item in response['items']]}
+            if 'count' in response:
+                trimmed['count'] = response['count']
+            return trimmed
+        return response
+
+    def request_pages(self, response, method, workers, rate_limiter=None, response_cache=None, **kwargs):
+        '''
+        Request all pages after the first `response` in pool of `workers` threads
+        and append their items to the response in the original order.
+        Items could shift between pages while requesting, so duplicates are skipped
+        '''
+        count = int(kwargs.get('count', 0)) or len(response['items'])
+        offsets = range(int(kwargs.get('offset', 0)) + count, response['count'], count)
+        if not offsets:
+            return response
+
+        stats = get_stats()
+
+        def request(offset):
+            with use_stats(stats):
+                return self.request(method, rate_limiter, response_cache, **dict(kwargs, offset=offset))
+
+        pool = ThreadPool(min(workers, len(offsets)))
+        try:
+            pages = pool.map(request, offsets)
+        finally:
+            pool.close()
+            pool.join()
+
+        pks = set([item.get(self.model.remote_pk_field) for item in response['items']])
+        for page in pages:
+            for item in page['items']:
+                pk = item.get(self.model.remote_pk_field)
+                if pk is None or pk not in pks:
+                    pks.add(pk)
+                    response['items'] += [item]
+
+        log.debug('Method %s: %d pages were requested in %d threads' % (method, len(offsets) + 1, workers))
+        return response
+
+    def parse_response(self, *args, **kwargs):
+        with phase('parse'):
+            return super(ApiManagerMixin, self).parse_response(*args, **kwargs)
+
+    def get_or_create_from_instance(self, *args, **kwargs):
+        with phase('save'):
+            return super(ApiManagerMixin, self).get_or_create_from_instance(*args, **kwargs)
+
+
+class BulkTimelineManagerMixin(VkontakteTimelineManager):
+
+    '''
+    Timeline manager, which is able to save the whole fetched page at once with argument `bulk`.
+    Works only with models, which remote_pk is a primary key
+    '''
+
+    @atomic
+    def fetch(self, bulk=False, touch=False, *args, **kwargs):
+        '''
+        Retrieve and save objects to local DB the same way as VkontakteTimelineManager.fetch().
+        If `bulk` is True, page of objects saved with get_or_create_from_instances(),
+        unchanged rows are not updated at all, unless `touch` is True
+        '''
+        after = kwargs.pop('after', None)
+        before = kwargs.pop('before', None)
+
+        result = self.get(*args, **kwargs)
+        if isinstance(result, list):
+
+            if self.timeline_force_ordering:
+                result.sort(key=self.get_timeline_date, reverse=True)
+
+            instances = []
+            for instance in result:
+
+                timeline_date = self.get_timeline_date(instance)
+
+                if timeline_date and isinstance(timeline_date, datetime):
+
+                    if after and after > timeline_date:
+                        break
+
+                    if before and before < timeline_date:
+                        continue
+
+                instances += [instance]
+
+            instances = self.save_page(instances, bulk, touch)
+            return self.model.objects.filter(pk__in=[instance.pk for instance in instances])
+        elif isinstance(result, QuerySet):
+            return result
+        else:
+            return self.get_or_create_from_instance(result)
+
+    def save_page(self, instances, bulk=False, touch=False):
+        '''
+        Save fetched page of instances by one get_or_create_from_instances() or row by row. Returns saved instances
+        '''
+        if bulk:
+            return self.get_or_create_from_instances(instances, touch)
+        else:
+            return [self.get_or_create_from_instance(instance) for instance in instances]
+
+    def get_or_create_from_instances(self, instances, touch=False):
+        '''
+        Bulk version of get_or_create_from_instance(): existing rows are selected by one query,
+        new rows are inserted by one query, only changed rows are updated.
+        Unchanged rows are not written, with `touch` they get only new `fetched` value by one query
+        '''
+        # the last instance with the same remote pk wins, as it would be saved the last
+        instances = list(OrderedDict([(instance.pk, instance) for instance in instances]).values())
+        if not instances:
+            return []
+
+        with phase('save'):
+            created, changed, unchanged = self.diff_instances(instances)
+            self.save_instances(created, changed, unchanged if touch else [])
+
+        created_pks = set([instance.pk for instance in created])
+        for instance in instances:
+            vkontakte_api_post_fetch.send(sender=instance.__class__, instance=instance,
+                                          created=(instance.pk in created_pks))
+        return instances
+
+    def diff_instances(self, instances):
+        '''
+        Split instances into lists of new, changed and unchanged ones, comparing with existing rows
+        '''
+        old_instances = self.model.objects.using(MASTER_DATABASE).in_bulk([instance.pk for instance in instances])
+        fields = [field.attname for field in self.model._meta.fields if field.attname != 'fetched']
+
+        created, changed, unchanged = [], [], []
+        for instance in instances:
+            self.prepare_instance(instance)
+
+            old_instance = old_instances.get(instance.pk)
+            if old_instance is None:
+                created += [instance]
+                continue
+
+            instance._substitute(old_instance)
+            if [getattr(instance, field) for field in fields] != [getattr(old_instance, field) for field in fields]:
+                changed += [instance]
+            else:
+                unchanged += [instance]
+
+        return created, changed, unchanged
+
+    def prepare_instance(self, instance):
+        if isinstance(instance, ActionableModelMixin):
+            # bulk_create() and update() don't call ActionableModelMixin.save()
+            instance.actions_count = sum([getattr(instance, field, None) or 0
+                                          for field in ['likes_count', 'reposts_count', 'comments_count']])
+
+    def save_instances(self, created, changed, unchanged):
+        if created:
+            self.model.objects.bulk_create(created)
+        if changed:
+            self.update_instances(changed)
+        if unchanged:
+            self.model.objects.filter(pk__in=[instance.pk for instance in unchanged]).update(fetched=timezone.now())
+
+        log.debug('Bulk fetch of %s: %d created, %d changed, %d unchanged' % (
+            self.model.__name__, len(created), len(changed), len(unchanged)))
+
+    def update_instances(self, instances):
+        '''
+        Update rows of changed instances. In PostgreSQL all rows are updated by one UPDATE ... FROM (VALUES ...),
+        in other databases row by row. Like bulk_create(), it doesn't send pre_save and post_save signals
+        '''
+        if connection.vendor != 'postgresql':
+            for instance in instances:
+                instance.save(force_update=True)
+            return
+
+        def cast(field):
+            if isinstance(field, models.AutoField):
+                return 'integer'
+            # PositiveIntegerField and others have CHECK constraint inside db_type()
+            return re.sub(r'\s+CHECK\s.*$', '', field.db_type(connection))
+
+        opts = self.model._meta
+        fields = [field for field in opts.fields if not field.primary_key]
+        columns = [opts.pk] + fields
+        qn = connection.ops.quote_name
+
+        row = '(%s)' % ', '.join(['%%s::%s' % cast(field) for field in columns])
+        params = []
+        for instance in instances:
+            params += [field.get_db_prep_save(getattr(instance, field.attname), connection) for field in columns]
+
+        connection.cursor().execute('UPDATE %(table)s SET %(set)s FROM (VALUES %(rows)s) AS v (%(columns)s) '
+                                    'WHERE %(table)s.%(pk)s = v.%(pk)s' % {
+                                        'table': qn(opts.db_table),
+                                        'set': ', '.join(['%s = v.%s' % (qn(field.column), qn(field.column))
+                                                          for field in fields]),
+                                        'rows': ', '.join([row] * len(instances)),
+                                        'columns': ', '.join([qn(field.column) for field in columns]),
+                                        'pk': qn(opts.pk.column),
+                                    }, params)
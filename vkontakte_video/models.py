@@ -1,66 +1,450 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from datetime import timedelta
+import calendar
+import hashlib
+import json
 import logging
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connection, models
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from vkontakte_api.decorators import fetch_all, atomic
 from vkontakte_api.mixins import CountOffsetManagerMixin, AfterBeforeManagerMixin, \
     OwnerableModelMixin, LikableModelMixin, ActionableModelMixin
-from vkontakte_api.models import VkontaktePKModel
+from vkontakte_api.models import VkontaktePKModel, MASTER_DATABASE
+from vkontakte_api.signals import vkontakte_api_post_fetch
 from vkontakte_comments.mixins import CommentableModelMixin
+from vkontakte_groups.models import Group
+from vkontakte_users.models import User
+
+from .instrumentation import instrumented, phase
+from .mixins import ApiManagerMixin, BulkTimelineManagerMixin
+from .utils import owner_cache
 
 log = logging.getLogger('vkontakte_video')
 
+# maximum number of API calls inside one request of method `execute`
+EXECUTE_CALLS_LIMIT = 25
+
+# maximum number of videos in argument `videos` of method video.get
+VIDEOS_IDS_LIMIT = 100
+
+# counters of video, compared between consecutive fetches
+VIDEO_COUNTERS = ('comments_count', 'likes_count', 'views_count')
+
+# fields of video, which are not needed for lists of videos
+VIDEO_HEAVY_FIELDS = ('description', 'player')
+
+# period of the newest videos of owner, which defines velocity of owner in OwnerSchedule
+SCHEDULE_VELOCITY_PERIOD = timedelta(days=30)
+
+# fields of items of video.get response, which are used by Video.parse() and fetch methods, the rest are dropped
+VIDEO_RESPONSE_FIELDS = ('id', 'owner_id', 'album_id', 'title', 'description', 'duration', 'date', 'views',
+                         'comments', 'likes', 'photo_130', 'player')
 
-class AlbumRemoteManager(CountOffsetManagerMixin):
+# fields of video, taken from response, which define Video.fingerprint
+VIDEO_FINGERPRINT_FIELDS = ('title', 'description', 'duration', 'views_count', 'likes_count', 'comments_count',
+                            'photo_130', 'player')
+
+
+def parse_owner(instance, response):
+    '''
+    Resolve owner of `instance` from response through utils.owner_cache instead of OwnerableModelMixin.parse(),
+    accounting time in phase `owner` of instrumented fetch
+    '''
+    if 'owner_id' in response:
+        with phase('owner'):
+            instance.owner = owner_cache.get(response.pop('owner_id'))
+
+
+class AlbumRemoteManager(CountOffsetManagerMixin, ApiManagerMixin):
 
     #timeline_force_ordering = True
 
     def get_timeline_date(self, instance):
         return instance.updated or instance.created or timezone.now()
 
+    @instrumented
     @atomic
+    @fetch_all
     def fetch(self, owner=None, **kwargs):
         if not owner:
             raise ValueError("You must specify owner, which albums you want to fetch")
 
-        kwargs['owner_id'] = self.model.get_owner_remote_id(owner)
+        with phase('owner'):
+            kwargs['owner_id'] = self.model.get_owner_remote_id(owner)
+            owner_cache.set(kwargs['owner_id'], owner)
         kwargs['extended'] = 1
 
         return super(AlbumRemoteManager, self).fetch(**kwargs)
 
+    def reconcile(self, owner, rate_limiter=None, **kwargs):
+        '''
+        Fetch all albums of owner and new videos only of albums, changed since the previous reconciliation.
+        Album is unchanged, if it has the same `videos_count` and `updated` and its videos were fetched before.
+        Videos of changed albums are fetched incrementally, `videos_count` is taken from the fresh response
+        even if it's less than before, because videos were deleted. Incremental fetch finds only videos
+        newer than the newest known one, but old video could be added to album later, so if album still has
+        less local videos than `videos_count`, all its videos are fetched. Extra kwargs are passed to
+        VideoRemoteManager.fetch_incremental() and fetch(). Returns list of changed albums
+        '''
+        old_albums = dict([(pk, (videos_count, updated)) for pk, videos_count, updated in self.model.objects.filter(
+            owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk).values_list(
+            'pk', 'videos_count', 'updated')])
+        synced_pks = set(VideoSyncState.objects.filter(album__in=old_albums.keys()).exclude(date=None)
+                         .values_list('album_id', flat=True))
+
+        changed, unchanged = [], 0
+        for album in self.fetch(owner=owner, all=True, rate_limiter=rate_limiter):
+            if album.pk in synced_pks and old_albums[album.pk] == (album.videos_count, album.updated):
+                unchanged += 1
+                continue
+
+            Video.remote.fetch_incremental(album=album, rate_limiter=rate_limiter, **kwargs)
+            if album.videos.count() < album.videos_count:
+                log.debug('Album %s has less videos than %d after incremental fetch, all videos are fetched' % (
+                    album, album.videos_count))
+                Video.remote.fetch(album=album, all=True, rate_limiter=rate_limiter, **kwargs)
+            changed += [album]
+
+        log.debug('Reconciliation of albums of %s: %d changed, %d unchanged' % (
+            owner, len(changed), unchanged))
+        return changed
+
+
+class VideoRemoteManager(CountOffsetManagerMixin, AfterBeforeManagerMixin, BulkTimelineManagerMixin, ApiManagerMixin):
+
+    response_fields = {
+        'video.get': VIDEO_RESPONSE_FIELDS,
+        'execute': VIDEO_RESPONSE_FIELDS,
+    }
+
+    @instrumented
+    def fetch(self, album=None, owner=None, ids=None, extended=1, incremental=False, sweep=False, resumable=False,
+              **kwargs):
+        '''
+        Fetch videos of album or owner. With `incremental` only new videos are fetched, see fetch_incremental(),
+        with `sweep` all videos of owner are fetched and missing ones are archived, see fetch_sweep(),
+        with `resumable` all videos are fetched by crawl, which continues after failures, see fetch_resumable()
+        '''
+        if not (album or owner):
+            raise ValueError("You must specify or video album or owner, which video you want to fetch")
 
-class VideoRemoteManager(CountOffsetManagerMixin, AfterBeforeManagerMixin):
+        kwargs['extended'] = extended
+        if ids or incremental or sweep or resumable:
+            # these modes fetch all pages by themselves
+            kwargs.pop('all', None)
+            if ids:
+                if incremental or sweep or resumable:
+                    raise ValueError("Argument `ids` is not compatible with incremental, sweep and resumable fetching")
+                owner_id = self.model.get_owner_remote_id(album.owner if album else owner)
+                return self.fetch_by_ids([(owner_id, video_id) for video_id in ids], album=album, **kwargs)
+            if incremental:
+                return self.fetch_incremental(album=album, owner=owner, **kwargs)
+            if resumable:
+                return self.fetch_resumable(album=album, owner=owner, **kwargs)
+            if album:
+                raise ValueError("Sweep is possible only for all videos of owner, not for album")
+            return self.fetch_sweep(owner=owner, **kwargs)
+
+        return self.fetch_pages(album=album, owner=owner, **kwargs)
 
     @atomic
     @fetch_all
-    def fetch(self, album=None, owner=None, ids=None, extended=1, **kwargs):
-        if not (album or owner):
-            raise ValueError("You must specify or video album or owner, which video you want to fetch")
-
-        if owner:
+    def fetch_pages(self, album=None, owner=None, extended=1, **kwargs):
+        with phase('owner'):
+            if album:
+                owner = album.owner
             kwargs['owner_id'] = self.model.get_owner_remote_id(owner)
+            owner_cache.set(kwargs['owner_id'], owner)
 
         if album:
-            kwargs['owner_id'] = album.owner_remote_id
             kwargs['album_id'] = album.remote_id
             kwargs['extra_fields'] = {'album': album}
 
-        if ids:
-            videos = []
-            owner_id = kwargs['owner_id']
-            for id in ids:
-                vid = '%s_%s' % (owner_id, id)
-                videos.append(vid)
-
-            kwargs['videos'] = ','.join(videos)
-
         kwargs['extended'] = extended
 
         return super(VideoRemoteManager, self).fetch(**kwargs)
 
+    @atomic
+    def fetch_by_ids(self, ids, album=None, extended=1, bulk=False, touch=False, workers=1, **kwargs):
+        '''
+        Fetch videos of any owners by `ids` - list of pairs (owner_id, video_id) or strings "owner_id_video_id".
+        Ids are requested by chunks of VIDEOS_IDS_LIMIT in pool of `workers` threads. Videos are saved
+        in the current thread with album from response, if it exists locally, or with `album`, if it's defined.
+        Extra kwargs are passed to api_response(). Returns queryset of fetched videos
+        '''
+        pairs = []
+        for video_id in ids:
+            if isinstance(video_id, basestring):
+                video_id = video_id.split('_')
+            pairs += [(int(video_id[0]), int(video_id[1]))]
+        pairs = list(OrderedDict.fromkeys(pairs))
+
+        calls = [{'videos': ','.join(['%s_%s' % pair for pair in pairs[i:i + VIDEOS_IDS_LIMIT]]),
+                  'count': VIDEOS_IDS_LIMIT} for i in range(0, len(pairs), VIDEOS_IDS_LIMIT)]
+        responses = self.api_responses(calls, workers=workers, extended=extended, **kwargs)
+
+        items = [item for response in responses for item in response['items']]
+        albums_ids = dict([(item['id'], item['album_id']) for item in items if item.get('album_id')])
+        if album is None:
+            existing = set(Album.objects.filter(pk__in=set(albums_ids.values())).values_list('pk', flat=True))
+            albums_ids = dict([(video_id, album_id) for video_id, album_id in albums_ids.items()
+                               if album_id in existing])
+
+        instances = self.parse_response(items, {'fetched': timezone.now()})
+        for instance in instances:
+            if album:
+                instance.album = album
+            elif instance.pk in albums_ids:
+                instance.album_id = albums_ids[instance.pk]
+
+        instances = self.save_page(instances, bulk, touch)
+        return self.model.objects.filter(pk__in=[instance.pk for instance in instances])
+
+    def iter_fetch(self, album=None, owner=None, page_size=100, batches=False, **kwargs):
+        '''
+        Generator of fetched videos. Yields saved videos (lists of videos of every page with `batches`)
+        as soon as the page is received, every page is saved in own transaction.
+        Memory usage is bounded by the size of one page
+        '''
+        offset = int(kwargs.pop('offset', 0))
+        while True:
+            videos = list(self.fetch(album=album, owner=owner, count=page_size, offset=offset, **kwargs)
+                          .order_by('-date'))
+            if not videos:
+                break
+
+            if batches:
+                yield videos
+            else:
+                for video in videos:
+                    yield video
+
+            offset += len(videos)
+
+    @atomic
+    def fetch_incremental(self, album=None, owner=None, **kwargs):
+        '''
+        Fetch videos, added after the newest video of the previous incremental fetch of the same owner or album.
+        Pages are fetched from the newest videos till the first already known one, after that
+        VideoSyncState of owner or album is moved to the newest fetched video.
+        Returns queryset of new videos, newer than the newest video of the previous incremental fetch
+        '''
+        state = VideoSyncState.objects.get_for(owner=owner, album=album)
+        mark = None
+        if state.date and 'after' not in kwargs:
+            mark = kwargs['after'] = state.date
+
+        videos = self.fetch(album=album, owner=owner, all=True, **kwargs)
+        state.update_from_videos(videos)
+        # `after` is inclusive, so the newest already known video is fetched again
+        return videos.filter(date__gt=mark) if mark else videos
+
+    def fetch_resumable(self, album=None, owner=None, page_size=100, extended=1, bulk=False, **kwargs):
+        '''
+        Fetch all videos of album or owner page by page, saving every page with checkpoint of the crawl
+        in VideoSyncState in own transaction. If crawl failed, the next call continues it from the checkpoint.
+        `fetched` of every video is updated, even if it's unchanged, to select videos of the crawl.
+        When `count` of videos decreases between pages, the following videos are shifted back, so offset
+        is rewound by the difference and the overlapping videos are read again.
+        Extra kwargs are passed to api_response(). Returns queryset of videos fetched during the whole crawl
+        '''
+        kwargs.pop('touch', None)
+        if album:
+            owner = album.owner
+        state = VideoSyncState.objects.get_for(owner=owner, album=album)
+        if state.crawl_started is None:
+            state.crawl_started = timezone.now().replace(microsecond=0)
+            state.crawl_offset = 0
+            state.crawl_count = None
+            state.save()
+        else:
+            log.info('Crawl of videos of %s %s is resumed from offset %d' % (owner, album or '', state.crawl_offset))
+
+        params = {'owner_id': self.model.get_owner_remote_id(owner), 'count': page_size, 'extended': extended}
+        if album:
+            params['album_id'] = album.remote_id
+        owner_cache.set(params['owner_id'], owner)
+
+        while True:
+            response = self.api_response('get', offset=state.crawl_offset, **dict(kwargs, **params))
+
+            if state.crawl_count is not None and response['count'] < state.crawl_count:
+                rewind = min(state.crawl_count - response['count'], state.crawl_offset)
+                log.debug('Count of videos of %s %s decreased from %d to %d, offset is rewound by %d' % (
+                    owner, album or '', state.crawl_count, response['count'], rewind))
+                state.crawl_offset -= rewind
+                state.crawl_count = response['count']
+                if rewind:
+                    continue
+
+            with atomic():
+                extra_fields = {'album': album, 'fetched': timezone.now()} if album else {'fetched': timezone.now()}
+                instances = self.save_page(self.parse_response(response['items'], extra_fields), bulk, touch=True)
+
+                state.crawl_offset += len(instances)
+                state.crawl_count = response['count']
+                finished = not instances or state.crawl_offset >= state.crawl_count
+                if finished:
+                    started, state.crawl_started, state.crawl_offset, state.crawl_count = \
+                        state.crawl_started, None, 0, None
+                state.save()
+
+            if finished:
+                break
+
+        videos = album.videos.all() if album else self.model.objects.filter(
+            owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk)
+        return videos.filter(fetched__gte=started)
+
+    def fetch_sweep(self, owner, page_size=100, **kwargs):
+        '''
+        Fetch all videos of owner page by page and archive local videos, which are missing in the response,
+        by one UPDATE. Videos are recognized as seen by `fetched`, which is updated for every fetched video
+        (even unchanged one, so argument `touch` is always True), so memory usage is bounded by the size
+        of one page. Videos, which appear again, are unarchived.
+        Returns queryset of videos seen during the pass
+        '''
+        for name in ['after', 'before', 'offset']:
+            if name in kwargs:
+                raise ValueError("Sweep needs the full pass over videos, argument `%s` is not allowed" % name)
+        kwargs['touch'] = True
+
+        # microseconds are dropped, because some databases don't keep them in `fetched`
+        started = timezone.now().replace(microsecond=0)
+        for videos in self.iter_fetch(owner=owner, page_size=page_size, batches=True, **kwargs):
+            pass
+
+        videos = self.model.objects.filter(owner_content_type=ContentType.objects.get_for_model(owner),
+                                           owner_id=owner.pk)
+        archived = videos.filter(archived=False).filter(models.Q(fetched__lt=started) | models.Q(fetched=None)) \
+            .update(archived=True)
+
+        log.debug('Sweep of videos of %s: %d videos archived' % (owner, archived))
+        return videos.filter(fetched__gte=started)
+
+    @atomic
+    def fetch_albums_videos(self, albums, count=100, extended=1, bulk=False, touch=False, rate_limiter=None):
+        '''
+        Fetch all videos of `albums`, packing up to EXECUTE_CALLS_LIMIT calls of video.get
+        into one request of method `execute`. Returns queryset of fetched videos
+        '''
+        albums = list(albums)
+        for album in albums:
+            owner_cache.set(album.owner_remote_id, album.owner)
+        fetched = dict([(album.pk, 0) for album in albums])
+        pending = [(album, 0) for album in albums]
+        pks = []
+
+        while pending:
+            batch, pending = pending[:EXECUTE_CALLS_LIMIT], pending[EXECUTE_CALLS_LIMIT:]
+
+            calls = ['API.video.get(%s)' % json.dumps({
+                'owner_id': album.owner_remote_id,
+                'album_id': album.remote_id,
+                'offset': offset,
+                'count': count,
+                'extended': extended,
+            }) for album, offset in batch]
+            responses = self.api_response('execute', methods_namespace='', code='return [%s];' % ','.join(calls),
+                                          rate_limiter=rate_limiter)
+
+            for (album, offset), response in zip(batch, responses):
+                if not response:
+                    log.warning('Method execute returned error for videos of album %s with offset %d' % (album, offset))
+                    continue
+
+                instances = self.parse_response(response['items'], {'album': album, 'fetched': timezone.now()})
+                instances = self.save_page(instances, bulk, touch)
+
+                pks += [instance.pk for instance in instances]
+                fetched[album.pk] += len(instances)
+
+                if response['items'] and offset + count < response['count']:
+                    pending += [(album, offset + count)]
+
+        for album in albums:
+            if fetched[album.pk] > album.videos_count:
+                album.videos_count = fetched[album.pk]
+                album.save()
+
+        return self.model.objects.filter(pk__in=pks)
+
+    def save_page(self, instances, bulk=False, touch=False):
+        instances = super(VideoRemoteManager, self).save_page(instances, bulk, touch)
+        if getattr(settings, 'VKONTAKTE_VIDEO_STATISTICS', False):
+            VideoStatistic.objects.record(instances)
+        return instances
+
+    def diff_instances(self, instances):
+        '''
+        Compare fingerprints of instances with fingerprints of existing rows, selected by one query without
+        other fields. Videos with the same fingerprint and album, which are not archived, are unchanged,
+        the rest ones are compared field by field with fully loaded rows
+        '''
+        rows = dict([(pk, (fingerprint, album_id, archived)) for pk, fingerprint, album_id, archived in
+                     self.model.objects.using(MASTER_DATABASE).filter(pk__in=[instance.pk for instance in instances])
+                     .values_list('pk', 'fingerprint', 'album_id', 'archived')])
+
+        unchanged, rest = [], []
+        for instance in instances:
+            fingerprint, album_id, archived = rows.get(instance.pk, (None, None, None))
+            if fingerprint and fingerprint == instance.fingerprint and not archived \
+                    and instance.album_id in (None, album_id):
+                self.prepare_instance(instance)
+                instance.album_id = album_id
+                instance.counters_changes = {}
+                unchanged += [instance]
+            else:
+                rest += [instance]
+
+        created, changed, rest_unchanged = super(VideoRemoteManager, self).diff_instances(rest)
+        return created, changed, unchanged + rest_unchanged
+
+
+class VideoQuerySet(QuerySet):
+
+    '''
+    Queries of common lists of videos, using composite indexes of Video.
+    Fields VIDEO_HEAVY_FIELDS are deferred, unless `full` is True
+    '''
+
+    def light(self, full=False):
+        return self if full else self.defer(*VIDEO_HEAVY_FIELDS)
+
+    def for_owner(self, owner, full=False):
+        return self.filter(owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk) \
+            .order_by('-date').light(full)
+
+    def in_album(self, album, full=False):
+        return self.filter(album=album).order_by('-date').light(full)
+
+    def top_viewed(self, full=False):
+        return self.order_by('-views_count').light(full)
+
+
+class VideoManager(models.Manager):
+
+    def get_queryset(self):
+        return VideoQuerySet(self.model, using=self._db)
+    get_query_set = get_queryset
+
+    def for_owner(self, *args, **kwargs):
+        return self.get_queryset().for_owner(*args, **kwargs)
+
+    def in_album(self, *args, **kwargs):
+        return self.get_queryset().in_album(*args, **kwargs)
+
+    def top_viewed(self, *args, **kwargs):
+        return self.get_queryset().top_viewed(*args, **kwargs)
+
 
 @python_2_unicode_compatible
 class Album(OwnerableModelMixin, VkontaktePKModel):
@@ -68,6 +452,7 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
     photo_160 = models.URLField(max_length=255)
     videos_count = models.PositiveIntegerField(u'Кол-во видеозаписей')
     title = models.CharField(max_length=200)
+    updated = models.DateTimeField(u'Дата обновления', null=True)
 
     objects = models.Manager()
     remote = AlbumRemoteManager(remote_pk=('remote_id',), version=5.27, methods_namespace='video', methods={
@@ -88,6 +473,9 @@ class Album(OwnerableModelMixin, VkontaktePKModel):
 
     def parse(self, response):
         response['videos_count'] = response.pop('count')
+        if 'updated_time' in response:
+            response['updated'] = response.pop('updated_time')
+        parse_owner(self, response)
         super(Album, self).parse(response)
 
     @atomic
@@ -109,16 +497,21 @@ class Video(OwnerableModelMixin, ActionableModelMixin, LikableModelMixin, Commen
     title = models.CharField(max_length=255)
     description = models.TextField()
     duration = models.PositiveIntegerField(u'Продолжительность')
-    views_count = models.PositiveIntegerField(u'Кол-во просмотров', default=0)
+    views_count = models.PositiveIntegerField(u'Кол-во просмотров', default=0, db_index=True)
+    archived = models.BooleanField(u'В архиве', default=False)
+    fingerprint = models.CharField(u'Отпечаток', max_length=32, default='', editable=False,
+                                   help_text=u'MD5 полей видеозаписи из ответа API')
     photo_130 = models.URLField(max_length=255)
     player = models.URLField(max_length=255)
     date = models.DateTimeField(help_text=u'Дата создания', db_index=True)
 
-    objects = models.Manager()
+    objects = VideoManager()
     remote = VideoRemoteManager(remote_pk=('remote_id',), version=5.27, methods_namespace='video', methods={
         'get': 'get',
     })
 
+    # composite indexes (owner_content_type_id, owner_id, date), (owner_content_type_id, owner_id, views_count)
+    # and (album_id, date) are created by migration 0009, because index_together needs Django 1.5
     class Meta:
         get_latest_by = 'remote_id'
         verbose_name = u'Видеозапись Вконтакте'
@@ -134,8 +527,428 @@ class Video(OwnerableModelMixin, ActionableModelMixin, LikableModelMixin, Commen
     def _substitute(self, old_instance):
         if old_instance.album_id:
             self.album_id = old_instance.album_id
+        self.counters_changes = self.get_counters_changes(old_instance)
         super(Video, self)._substitute(old_instance)
 
+    def get_counters_changes(self, old_instance=None):
+        '''
+        Return dict with differences of VIDEO_COUNTERS between this and old instance
+        '''
+        changes = {}
+        for field in VIDEO_COUNTERS:
+            value = getattr(self, field) or 0
+            old_value = (getattr(old_instance, field) or 0) if old_instance else 0
+            if value != old_value:
+                changes[field] = value - old_value
+        return changes
+
     def parse(self, response):
         response['views_count'] = response.pop('views')
+        if 'comments' in response:
+            response['comments_count'] = response.pop('comments')
+        parse_owner(self, response)
         super(Video, self).parse(response)
+        self.fingerprint = self.get_fingerprint()
+
+    def get_fingerprint(self):
+        '''
+        MD5 of VIDEO_FINGERPRINT_FIELDS: if it's the same as stored one, video wasn't changed since the last fetch
+        '''
+        values = [getattr(self, field) for field in VIDEO_FINGERPRINT_FIELDS]
+        return hashlib.md5(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+class VideoSyncStateManager(models.Manager):
+
+    def get_for(self, owner=None, album=None):
+        if album:
+            owner = album.owner
+        return self.get_or_create(owner_content_type=ContentType.objects.get_for_model(owner), owner_id=owner.pk,
+                                  album=album)[0]
+
+
+@python_2_unicode_compatible
+class VideoSyncState(OwnerableModelMixin):
+
+    '''
+    High-water mark of incremental fetching of videos of owner or album: the newest fetched video,
+    and checkpoint of resumable crawl of all videos
+    '''
+    album = models.ForeignKey(Album, null=True, related_name='sync_states')
+    date = models.DateTimeField(u'Дата создания последней видеозаписи', null=True)
+    video_remote_id = models.BigIntegerField(u'ID последней видеозаписи', null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    # checkpoint of unfinished resumable crawl
+    crawl_started = models.DateTimeField(u'Начало обхода', null=True)
+    crawl_offset = models.PositiveIntegerField(u'Смещение обхода', default=0)
+    crawl_count = models.PositiveIntegerField(u'Кол-во видеозаписей при обходе', null=True)
+
+    objects = VideoSyncStateManager()
+
+    class Meta:
+        unique_together = ('owner_content_type', 'owner_id', 'album')
+        verbose_name = u'Синхронизация видеозаписей'
+        verbose_name_plural = u'Синхронизации видеозаписей'
+
+    def __str__(self):
+        return u'%s %s: %s' % (self.owner, self.album or '', self.date)
+
+    def update_from_videos(self, videos):
+        try:
+            video = videos.order_by('-date', '-remote_id')[0]
+        except IndexError:
+            return
+
+        if not self.date or video.date > self.date:
+            self.date = video.date
+            self.video_remote_id = video.remote_id
+            self.save()
+
+
+class VideoRefreshManager(models.Manager):
+
+    def enqueue(self, video, changes):
+        '''
+        Put refreshing of comments and likes of video with changed counters into the queue
+        '''
+        if not (changes.get('comments_count') or changes.get('likes_count')):
+            return
+
+        refresh = self.get_or_create(video=video)[0]
+        for field in VIDEO_COUNTERS:
+            setattr(refresh, field, getattr(refresh, field) + changes.get(field, 0))
+        refresh.comments = refresh.comments or bool(changes.get('comments_count'))
+        refresh.likes = refresh.likes or bool(changes.get('likes_count'))
+        refresh.priority = refresh.get_priority(video)
+        refresh.save()
+        return refresh
+
+    def process(self, limit=100):
+        '''
+        Refresh comments and likes of `limit` videos with the highest priority.
+        Returns number of refreshed videos, failed refreshes stay in the queue with halved priority
+        after every attempt, so they don't block the rest of the queue
+        '''
+        count = 0
+        for refresh in self.select_related('video').order_by('-priority')[:limit]:
+            try:
+                refresh.process()
+            except Exception as e:
+                log.error('Error while refreshing comments and likes of video %s: %r' % (refresh.video_id, e))
+                refresh.attempts += 1
+                refresh.priority = refresh.get_priority(refresh.video)
+                refresh.save()
+            else:
+                count += 1
+        return count
+
+
+@python_2_unicode_compatible
+class VideoRefresh(models.Model):
+
+    '''
+    Queue of videos with changed counters, waiting for refreshing of comments and likes.
+    Videos are added there after fetching, if setting VKONTAKTE_VIDEO_REFRESH_QUEUE is True
+    '''
+    video = models.OneToOneField(Video, related_name='refresh')
+    comments = models.BooleanField(u'Обновить комментарии', default=False)
+    likes = models.BooleanField(u'Обновить лайки', default=False)
+    comments_count = models.IntegerField(u'Изменение кол-ва комментариев', default=0)
+    likes_count = models.IntegerField(u'Изменение кол-ва лайков', default=0)
+    views_count = models.IntegerField(u'Изменение кол-ва просмотров', default=0)
+    priority = models.FloatField(default=0, db_index=True)
+    attempts = models.PositiveSmallIntegerField(u'Неудачных попыток', default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = VideoRefreshManager()
+
+    class Meta:
+        verbose_name = u'Обновление видеозаписи Вконтакте'
+        verbose_name_plural = u'Обновления видеозаписей Вконтакте'
+
+    def __str__(self):
+        return u'%s: %s' % (self.video_id, self.priority)
+
+    def get_priority(self, video):
+        '''
+        Sum of absolute changes of counters, divided by the age of video in days
+        and by 2 in power of failed attempts: the more changes and the newer video, the higher priority
+        '''
+        changes = sum([abs(getattr(self, field)) for field in VIDEO_COUNTERS])
+        age = (timezone.now() - video.date).days if video.date else 0
+        return float(changes) / (1 + max(age, 0)) / 2 ** self.attempts
+
+    def process(self):
+        if self.comments:
+            self.video.fetch_comments(all=True)
+        if self.likes:
+            self.video.fetch_likes(all=True)
+        self.delete()
+
+
+class VideoStatisticManager(models.Manager):
+
+    def record(self, videos, time=None):
+        '''
+        Save samples of counters of new videos and videos with changed counters by one query.
+        Returns list of saved samples
+        '''
+        time = time or timezone.now()
+        statistics = []
+        for video in videos:
+            # counters_changes are defined by Video._substitute() only for existing videos
+            changes = getattr(video, 'counters_changes', None)
+            if changes is None or changes:
+                statistics += [self.model(video_id=video.pk, time=time,
+                                          **dict([(field, getattr(video, field) or 0) for field in VIDEO_COUNTERS]))]
+        if statistics:
+            self.bulk_create(statistics)
+        return statistics
+
+    def purge(self, before):
+        '''
+        Delete samples older than `before`. Returns number of deleted samples
+        '''
+        queryset = self.filter(time__lt=before)
+        count = queryset.count()
+        queryset.delete()
+        return count
+
+    def downsample(self, before, interval=timedelta(days=1), chunk_size=1000):
+        '''
+        Keep only the last sample of every video during every `interval` among samples older than `before`.
+        Samples are read by chunks of `chunk_size` in the order of (video, time), every chunk starts after
+        the last sample of the previous one, so only one chunk is kept in memory.
+        Returns number of deleted samples
+        '''
+        interval = interval.days * 86400 + interval.seconds
+
+        count = 0
+        last = None
+        position = None
+        while True:
+            samples = self.filter(time__lt=before)
+            if position:
+                pk, video_id, time = position
+                samples = samples.filter(models.Q(video__gt=video_id) | models.Q(video=video_id, time__lt=time)
+                                         | models.Q(video=video_id, time=time, pk__lt=pk))
+            samples = list(samples.order_by('video', '-time', '-pk').values_list('pk', 'video_id', 'time')[:chunk_size])
+            if not samples:
+                break
+
+            pks = []
+            for pk, video_id, time in samples:
+                bucket = (video_id, calendar.timegm(time.utctimetuple()) // interval)
+                if bucket == last:
+                    pks += [pk]
+                last = bucket
+
+            if pks:
+                self.filter(pk__in=pks).delete()
+                count += len(pks)
+            position = samples[-1]
+
+        return count
+
+
+@python_2_unicode_compatible
+class VideoStatistic(models.Model):
+
+    '''
+    Append-only history of counters of video, saved only when counters are changed
+    '''
+    # there is composite index (video_id, time), created by migration 0008, because index_together needs Django 1.5
+    video = models.ForeignKey(Video, related_name='statistics', db_index=False)
+    time = models.DateTimeField(u'Время')
+    views_count = models.PositiveIntegerField(u'Кол-во просмотров', default=0)
+    likes_count = models.PositiveIntegerField(u'Кол-во лайков', default=0)
+    comments_count = models.PositiveIntegerField(u'Кол-во комментариев', default=0)
+
+    objects = VideoStatisticManager()
+
+    class Meta:
+        get_latest_by = 'time'
+        verbose_name = u'Статистика видеозаписи Вконтакте'
+        verbose_name_plural = u'Статистика видеозаписей Вконтакте'
+
+    def __str__(self):
+        return u'%s %s' % (self.video_id, self.time)
+
+
+class OwnerScheduleManager(models.Manager):
+
+    def add(self, owner, due=None):
+        '''
+        Put owner into the schedule. New owner is due at once or at `due`, existing one is moved to `due`,
+        if it's defined. Returns OwnerSchedule of owner
+        '''
+        schedule, created = self.get_or_create(owner_content_type=ContentType.objects.get_for_model(owner),
+                                               owner_id=owner.pk, defaults={'next_due': due or timezone.now()})
+        if not created and due:
+            schedule.next_due = due
+            schedule.save()
+        return schedule
+
+    def due(self, now=None):
+        '''
+        Owners, which synchronization time came and which are not leased, in the order of `next_due`
+        '''
+        now = now or timezone.now()
+        return self.filter(next_due__lte=now).filter(models.Q(lease_expires=None) | models.Q(lease_expires__lt=now)) \
+            .order_by('next_due')
+
+    def nearest(self, now=None):
+        '''
+        Time, when some owner could be claimed: the nearest `next_due` of not leased owners
+        or the nearest expiration of lease. Returns None for empty schedule
+        '''
+        now = now or timezone.now()
+        free = models.Q(lease_expires=None) | models.Q(lease_expires__lt=now)
+        times = list(self.filter(free).order_by('next_due').values_list('next_due', flat=True)[:1]) \
+            + list(self.filter(lease_expires__gte=now).order_by('lease_expires')
+                   .values_list('lease_expires', flat=True)[:1])
+        return min(times) if times else None
+
+    @atomic
+    def claim(self, worker, limit=100, lease=600, now=None):
+        '''
+        Lease up to `limit` due owners to `worker` for `lease` seconds, so other processes and hosts
+        don't synchronize them at the same time. Expired leases are claimed again.
+        In PostgreSQL rows are claimed by one UPDATE of rows, selected with FOR UPDATE SKIP LOCKED (9.5+),
+        in other databases every row is claimed by UPDATE with condition of free lease (compare-and-set).
+        Returns queryset of claimed schedules
+        '''
+        now = now or timezone.now()
+        expires = now + timedelta(seconds=lease)
+
+        if connection.vendor == 'postgresql':
+            table = self.model._meta.db_table
+            cursor = connection.cursor()
+            cursor.execute('UPDATE %(table)s SET leased_by = %%s, lease_expires = %%s WHERE id IN ('
+                           'SELECT id FROM %(table)s WHERE next_due <= %%s '
+                           'AND (lease_expires IS NULL OR lease_expires < %%s) '
+                           'ORDER BY next_due LIMIT %%s FOR UPDATE SKIP LOCKED) RETURNING id' % {'table': table},
+                           [worker, expires, now, now, limit])
+            pks = [row[0] for row in cursor.fetchall()]
+        else:
+            pks = []
+            for pk in self.due(now).values_list('pk', flat=True)[:limit]:
+                free = models.Q(lease_expires=None) | models.Q(lease_expires__lt=now)
+                if self.filter(pk=pk).filter(free).update(leased_by=worker, lease_expires=expires):
+                    pks += [pk]
+
+        return self.filter(pk__in=pks).order_by('next_due')
+
+    def heartbeat(self, worker, pks, lease=600):
+        '''
+        Prolong leases of `worker` for `lease` seconds from now. Returns number of prolonged leases,
+        leases, which were expired and claimed by other worker, are not prolonged
+        '''
+        return self.filter(pk__in=pks, leased_by=worker).update(
+            lease_expires=timezone.now() + timedelta(seconds=lease))
+
+
+@python_2_unicode_compatible
+class OwnerSchedule(OwnerableModelMixin):
+
+    '''
+    Priority queue of owners, which videos are synchronized by scheduler, see sync.run_schedule().
+    Owners are leased to processes of scheduler by claim(), so any number of processes and hosts
+    could share one schedule. Owner is due at `next_due`, interval between synchronizations is adapted
+    to `velocity` of owner - number of videos per day during the last SCHEDULE_VELOCITY_PERIOD.
+    Interval is limited by settings VKONTAKTE_VIDEO_SCHEDULE_MIN_INTERVAL (1 hour by default)
+    and VKONTAKTE_VIDEO_SCHEDULE_MAX_INTERVAL (30 days by default) in seconds
+    '''
+    next_due = models.DateTimeField(u'Время следующей синхронизации', db_index=True)
+    interval = models.PositiveIntegerField(u'Интервал синхронизации, сек', default=0)
+    velocity = models.FloatField(u'Кол-во видеозаписей в день', default=0)
+    failures = models.PositiveIntegerField(u'Кол-во ошибок подряд', default=0)
+    synced = models.DateTimeField(u'Время последней синхронизации', null=True)
+
+    # lease of owner, claimed by one of processes of scheduler
+    leased_by = models.CharField(u'Обработчик', max_length=100, blank=True)
+    lease_expires = models.DateTimeField(u'Окончание аренды', null=True, db_index=True)
+
+    objects = OwnerScheduleManager()
+
+    class Meta:
+        unique_together = ('owner_content_type', 'owner_id')
+        verbose_name = u'Расписание синхронизации'
+        verbose_name_plural = u'Расписания синхронизации'
+
+    def __str__(self):
+        return u'%s: %s' % (self.owner, self.next_due)
+
+    @property
+    def min_interval(self):
+        return getattr(settings, 'VKONTAKTE_VIDEO_SCHEDULE_MIN_INTERVAL', 3600)
+
+    @property
+    def max_interval(self):
+        return getattr(settings, 'VKONTAKTE_VIDEO_SCHEDULE_MAX_INTERVAL', 30 * 86400)
+
+    def get_velocity(self, now=None):
+        '''
+        Number of videos of owner per day, created during the last SCHEDULE_VELOCITY_PERIOD
+        '''
+        since = (now or timezone.now()) - SCHEDULE_VELOCITY_PERIOD
+        count = Video.objects.filter(owner_content_type_id=self.owner_content_type_id, owner_id=self.owner_id,
+                                     date__gte=since).count()
+        return float(count) / SCHEDULE_VELOCITY_PERIOD.days
+
+    def get_interval(self, new_videos):
+        '''
+        Seconds till the next synchronization: expected time till the next video of active owner, which
+        new videos were found, otherwise the previous interval is doubled (exponential backoff of quiet owner)
+        '''
+        if new_videos and self.velocity:
+            interval = 86400. / self.velocity
+        else:
+            interval = (self.interval or self.min_interval) * 2
+        return int(min(max(interval, self.min_interval), self.max_interval))
+
+    def reschedule(self, new_videos=0, failed=False, now=None, worker=None):
+        '''
+        Move owner to the next synchronization after synchronization with `new_videos` found and release its lease.
+        Failed synchronization is retried after exponentially growing delay, interval of owner is kept.
+        With `worker` the row is updated only if it's still leased by the worker: if the lease expired
+        and owner was claimed by other worker, nothing is changed and False is returned
+        '''
+        now = now or timezone.now()
+        if failed:
+            self.failures += 1
+            delay = min(self.min_interval * 2 ** (self.failures - 1), self.max_interval)
+        else:
+            self.failures = 0
+            self.synced = now
+            self.velocity = self.get_velocity(now)
+            self.interval = delay = self.get_interval(new_videos)
+
+        self.next_due = now + timedelta(seconds=delay)
+        self.leased_by = ''
+        self.lease_expires = None
+
+        if worker is None:
+            self.save()
+            return True
+
+        fields = ['next_due', 'interval', 'velocity', 'failures', 'synced', 'leased_by', 'lease_expires']
+        if not type(self).objects.filter(pk=self.pk, leased_by=worker).update(
+                **dict([(field, getattr(self, field)) for field in fields])):
+            log.warning('Lease of %s by worker %s expired, owner is not rescheduled' % (self.owner, worker))
+            return False
+        return True
+
+
+@receiver(vkontakte_api_post_fetch, sender=Video)
+def enqueue_video_refresh(sender, instance, created, **kwargs):
+    if getattr(settings, 'VKONTAKTE_VIDEO_REFRESH_QUEUE', False):
+        changes = instance.get_counters_changes() if created else getattr(instance, 'counters_changes', {})
+        VideoRefresh.objects.enqueue(instance, changes)
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=User)
+def discard_cached_owner(sender, instance, **kwargs):
+    owner_cache.discard(OwnerableModelMixin.get_owner_remote_id(instance))
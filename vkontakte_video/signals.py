@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+# sent after each instrumented fetch of remote manager with instrumentation.FetchStats
+vkontakte_video_fetch_stats = Signal(providing_args=['stats'])
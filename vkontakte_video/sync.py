@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+
+from .models import Album, Video, OwnerSchedule
+from .utils import TokenBucket
+
+log = logging.getLogger('vkontakte_video')
+
+REQUESTS_PER_SECOND = getattr(settings, 'VKONTAKTE_VIDEO_REQUESTS_PER_SECOND', 3)
+
+# modes of synchronization: all videos of all albums, only new videos of all albums, only albums
+SYNC_MODES = ('full', 'incremental', 'albums')
+
+
+class RequestsCounter(object):
+
+    '''
+    Thread-safe wrapper of rate limiter, counting requests to API
+    '''
+
+    def __init__(self, rate_limiter=None):
+        self.rate_limiter = rate_limiter
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            self.count += tokens
+        if self.rate_limiter:
+            self.rate_limiter.acquire(tokens)
+
+
+class OwnerSyncResult(object):
+
+    '''
+    Result of synchronization of albums and videos of one owner
+    '''
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.albums = 0
+        self.videos = 0
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def __repr__(self):
+        return '<OwnerSyncResult: %s albums=%d videos=%d error=%r>' % (self.owner, self.albums, self.videos, self.error)
+
+    @property
+    def success(self):
+        return self.error is None
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+
+class SyncReport(object):
+
+    '''
+    Report of synchronization of many owners with list of OwnerSyncResult
+    '''
+
+    def __init__(self, results=None, requests=0, duration=0.):
+        self.results = results or []
+        self.requests = requests
+        self.duration = duration
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.success]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.success]
+
+    @property
+    def albums(self):
+        return sum([result.albums for result in self.results])
+
+    @property
+    def videos(self):
+        return sum([result.videos for result in self.results])
+
+    def as_dict(self):
+        return {
+            'owners': len(self),
+            'succeeded': len(self.succeeded),
+            'failed': [{'owner_id': Album.get_owner_remote_id(result.owner), 'error': repr(result.error)}
+                       for result in self.failed],
+            'albums': self.albums,
+            'videos': self.videos,
+            'requests': self.requests,
+            'duration': round(self.duration, 3),
+            'videos_per_second': round(self.videos / self.duration, 3) if self.duration else 0.,
+            'requests_per_second': round(self.requests / self.duration, 3) if self.duration else 0.,
+        }
+
+
+def sync_owner(owner, rate_limiter=None, mode='full', **kwargs):
+    '''
+    Fetch all albums of owner and videos of every album: all of them in mode `full`,
+    only new ones in mode `incremental`, none in mode `albums`.
+    Extra kwargs are passed to Album.fetch_videos(). Returns OwnerSyncResult, exceptions are saved to it
+    '''
+    if mode not in SYNC_MODES:
+        raise ValueError("Argument `mode` should be one of %s, not %s" % (', '.join(SYNC_MODES), mode))
+
+    result = OwnerSyncResult(owner)
+    try:
+        albums = Album.remote.fetch(owner=owner, all=True, rate_limiter=rate_limiter)
+        result.albums = albums.count()
+
+        for album in albums:
+            if mode == 'full':
+                videos = album.fetch_videos(all=True, rate_limiter=rate_limiter, **kwargs)
+            elif mode == 'incremental':
+                videos = Video.remote.fetch(album=album, incremental=True, rate_limiter=rate_limiter, **kwargs)
+            else:
+                break
+            result.videos += videos.count()
+    except Exception as e:
+        log.error('Error while synchronization of videos of owner %s: %r' % (owner, e))
+        result.error = e
+    finally:
+        result.finished = time.time()
+
+    return result
+
+
+def sync_owners(owners, workers=1, rate_limiter=None, progress=None, **kwargs):
+    '''
+    Fetch albums and videos of many owners in pool of `workers` threads.
+    All threads share the same `rate_limiter`, by default it's TokenBucket with
+    VKONTAKTE_VIDEO_REQUESTS_PER_SECOND requests per second. Returns SyncReport.
+    With one worker owners are synchronized in the current thread.
+    Callable `progress` is called in the current thread with SyncReport of already synchronized owners
+    after every owner. Extra kwargs are passed to sync_owner()
+    '''
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(REQUESTS_PER_SECOND)
+    rate_limiter = RequestsCounter(rate_limiter)
+    report = SyncReport()
+    started = time.time()
+
+    def add_result(result):
+        report.results += [result]
+        report.requests = rate_limiter.count
+        report.duration = time.time() - started
+        if progress:
+            progress(report)
+
+    def sync(owner):
+        try:
+            return sync_owner(owner, rate_limiter=rate_limiter, **kwargs)
+        finally:
+            if workers > 1:
+                # every thread has own DB connection, which should be closed
+                connection.close()
+
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            for result in pool.imap_unordered(sync, owners):
+                add_result(result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for owner in owners:
+            add_result(sync(owner))
+
+    log.info('Synchronization of %d owners finished: %d albums, %d videos, %d errors' % (
+        len(report), report.albums, report.videos, len(report.failed)))
+    return report
+
+
+class LeaseHeartbeat(object):
+
+    '''
+    Context manager, prolonging leases of owners of the worker in background thread
+    every third of `lease` seconds, while owners are synchronized
+    '''
+
+    def __init__(self, worker, pks, lease=600):
+        self.worker = worker
+        self.pks = pks
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lease / 3.):
+                try:
+                    OwnerSchedule.objects.heartbeat(self.worker, self.pks, self.lease)
+                except Exception as e:
+                    log.error('Error while prolonging leases of worker %s: %r' % (self.worker, e))
+        finally:
+            connection.close()
+
+
+def get_worker_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def run_schedule(workers=1, rate_limiter=None, progress=None, once=False, limit=100, sleep=60, mode='incremental',
+                 worker=None, lease=600, **kwargs):
+    '''
+    Worker loop of scheduler: claim up to `limit` due owners of OwnerSchedule, synchronize them by sync_owners()
+    and reschedule every owner by the number of found videos. Owners are leased to `worker` (host and pid
+    by default) for `lease` seconds and leases are prolonged during synchronization, so many processes
+    on many hosts could run the loop without overlapping; leases of died processes expire and owners are
+    claimed again. Without due owners it sleeps till the nearest due owner or expiration of lease,
+    but no longer than `sleep` seconds.
+    With `once` it returns after the first batch of due owners.
+    Extra kwargs are passed to sync_owners(). Returns SyncReport of all synchronized owners
+    '''
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(REQUESTS_PER_SECOND)
+    worker = worker or get_worker_name()
+    total = SyncReport()
+
+    while True:
+        schedules = list(OwnerSchedule.objects.claim(worker, limit, lease).prefetch_related('owner'))
+        if not schedules:
+            if once:
+                break
+            # owners, leased by other workers, are not available till expiration of their leases
+            nearest = OwnerSchedule.objects.nearest()
+            wait = (nearest - timezone.now()).total_seconds() if nearest else sleep
+            time.sleep(min(max(wait, 1), sleep))
+            continue
+
+        schedules = OrderedDict([((schedule.owner_content_type_id, schedule.owner_id), schedule)
+                                 for schedule in schedules])
+
+        def reschedule(report):
+            result = report.results[-1]
+            schedule = schedules[(ContentType.objects.get_for_model(result.owner).pk, result.owner.pk)]
+            schedule.reschedule(result.videos, failed=not result.success, worker=worker)
+            if progress:
+                progress(report)
+
+        with LeaseHeartbeat(worker, [schedule.pk for schedule in schedules.values()], lease):
+            report = sync_owners([schedule.owner for schedule in schedules.values()], workers=workers,
+                                 rate_limiter=rate_limiter, progress=reschedule, mode=mode, **kwargs)
+        total.results += report.results
+        total.requests += report.requests
+        total.duration += report.duration
+
+        if once:
+            break
+
+    return total
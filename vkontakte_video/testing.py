@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from copy import deepcopy
+import json
+import re
+import threading
+
+from . import mixins
+
+FAKE_DATE = 1386074580
+
+
+def album_resource(remote_id, owner_id, **kwargs):
+    '''
+    Resource of video.getAlbums response with fake values
+    '''
+    resource = {
+        'id': remote_id,
+        'owner_id': owner_id,
+        'title': 'Album %s' % remote_id,
+        'count': 0,
+        'photo_160': 'http://cs619722.vk.me/u8704019/video/m_ef3493e1.jpg',
+    }
+    resource.update(kwargs)
+    return resource
+
+
+def video_resource(remote_id, owner_id, **kwargs):
+    '''
+    Resource of video.get response with fake values
+    '''
+    resource = {
+        'id': remote_id,
+        'owner_id': owner_id,
+        'title': 'Video %s' % remote_id,
+        'description': 'description',
+        'duration': 60,
+        'views': 10,
+        'comments': 1,
+        'likes': {'count': 2, 'user_likes': 0},
+        'date': FAKE_DATE - remote_id,
+        'photo_130': 'http://cs313422.vk.me/u163668241/video/s_6819a7d1.jpg',
+        'player': 'http://www.youtube.com/embed/UmDAmM53bU0',
+    }
+    resource.update(kwargs)
+    return resource
+
+
+class FakeVkontakteApi(object):
+
+    '''
+    Local replacement of vkontakte API with canned responses of methods `video.getAlbums` and `video.get`.
+    Usage:
+
+        api = FakeVkontakteApi()
+        api.add_album(-16297716, 50850761)
+        api.add_video(-16297716, 166742757, album_id=50850761)
+        with api.patch():
+            Album.remote.fetch(owner=group)
+
+    All calls are registered in the list `calls` as tuples (method, kwargs).
+    Method `execute` supports only code, returning list of API.video.get() calls
+    '''
+
+    def __init__(self):
+        self.albums = {}
+        self.videos = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def patch(self):
+        '''
+        Make all remote calls of managers through this fake API inside the block
+        '''
+        original = mixins.api_call
+        mixins.api_call = self
+        try:
+            yield self
+        finally:
+            mixins.api_call = original
+
+    def add_album(self, owner_id, remote_id, **kwargs):
+        resource = album_resource(remote_id, owner_id, **kwargs)
+        self.albums.setdefault(owner_id, []).append(resource)
+        return resource
+
+    def add_video(self, owner_id, remote_id, album_id=None, **kwargs):
+        '''
+        Add video to the end of owner's list, so videos should be added from the newest to the oldest
+        '''
+        resource = video_resource(remote_id, owner_id, **kwargs)
+        if album_id:
+            resource['album_id'] = album_id
+        self.videos.setdefault(owner_id, []).append(resource)
+        return resource
+
+    def __call__(self, method, **kwargs):
+        with self.lock:
+            self.calls.append((method, kwargs))
+
+        try:
+            handler = getattr(self, method.replace('.', '_'))
+        except AttributeError:
+            raise NotImplementedError("Method %s is not supported by %s" % (method, self.__class__.__name__))
+
+        return deepcopy(handler(**kwargs))
+
+    def paginate(self, items, offset=0, count=100, **kwargs):
+        offset = int(offset)
+        return {'count': len(items), 'items': items[offset:offset + int(count)]}
+
+    def video_getAlbums(self, owner_id, **kwargs):
+        albums = []
+        for album in self.albums.get(int(owner_id), []):
+            album = dict(album)
+            album['count'] = len([video for video in self.videos.get(album['owner_id'], [])
+                                  if video.get('album_id') == album['id']])
+            albums += [album]
+        return self.paginate(albums, **kwargs)
+
+    def video_get(self, owner_id=None, album_id=None, videos=None, **kwargs):
+        if videos:
+            items = []
+            for pair in videos.split(','):
+                owner_id, remote_id = [int(value) for value in pair.split('_')]
+                items += [video for video in self.videos.get(owner_id, []) if video['id'] == remote_id]
+            return {'count': len(items), 'items': items}
+
+        items = self.videos.get(int(owner_id), [])
+        if album_id:
+            items = [video for video in items if video.get('album_id') == int(album_id)]
+        return self.paginate(items, **kwargs)
+
+    def execute(self, code, **kwargs):
+        return [self.video_get(**json.loads(params)) for params in re.findall(r'API\.video\.get\((\{[^}]*\})\)', code)]
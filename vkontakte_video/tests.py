@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
+from copy import deepcopy
+from datetime import datetime, timedelta
 import json
-
-from django.test import TestCase
+from StringIO import StringIO
+import threading
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.forms.models import inlineformset_factory
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.utils import timezone
+from django.utils.unittest import skipIf
 import mock
 from vkontakte_comments.models import Comment
 from vkontakte_groups.factories import GroupFactory
 from vkontakte_users.factories import UserFactory, User
 
 from .factories import AlbumFactory, VideoFactory
-from .models import Album, Video
+from .admin import ApproximateCountPaginator, LimitedInlineFormSet
+from .api import api_call
+from .benchmarks import run_benchmark
+from .cache import MemoryResponseCache
+from .export import export, iter_albums, iter_videos
+from .models import Album, Video, VideoRefresh, VideoStatistic, VideoSyncState, OwnerSchedule, VIDEO_RESPONSE_FIELDS
+from .signals import vkontakte_video_fetch_stats
+from .sync import sync_owners, run_schedule
+from .testing import FakeVkontakteApi, video_resource, FAKE_DATE
+from .utils import QueriesCounter, TokenBucket, owner_cache
 
 GROUP_ID = 16297716  # https://vk.com/cocacola
 ALBUM_ID = 50850761  # 9 videos
@@ -21,6 +40,20 @@ VIDEO_CRUD_ID = 170947024
 USER_ID = 201164356
 
 
+def fake_api_of(owners):
+    '''
+    FakeVkontakteApi with 2 albums of 3 videos of every owner
+    '''
+    api = FakeVkontakteApi()
+    for owner in owners:
+        for album_id in range(1, 3):
+            api.add_album(-owner.remote_id, owner.remote_id + album_id)
+            for video_id in range(1, 4):
+                api.add_video(-owner.remote_id, owner.remote_id + album_id * 10 + video_id,
+                              album_id=owner.remote_id + album_id)
+    return api
+
+
 class VkontakteVideosTest(TestCase):
 
     def test_fetch_owner_albums(self):
@@ -158,6 +191,126 @@ class VkontakteVideosTest(TestCase):
         videos = Video.remote.fetch(album=album, ids=[VIDEO_ID])
         self.assertEqual(videos.count(), 1)
 
+    def test_fetch_videos_bulk(self):
+        owner = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=owner)
+        VideoFactory(remote_id=1, owner=owner, album=album, title='Old title')
+
+        with mock.patch('vkontakte_video.models.VideoRemoteManager.api_call',
+                        side_effect=lambda **kw: [video_resource(i, -GROUP_ID) for i in range(1, 4)]):
+            videos = Video.remote.fetch(owner=owner, bulk=True)
+
+        self.assertEqual(videos.count(), 3)
+        self.assertEqual(Video.objects.count(), 3)
+        self.assertEqual(Video.objects.filter(owner_id=owner.pk).count(), 3)
+
+        # `album` is kept by Video._substitute()
+        video = Video.objects.get(remote_id=1)
+        self.assertEqual(video.album, album)
+        self.assertEqual(video.title, 'Video 1')
+        self.assertEqual(video.views_count, 10)
+        self.assertEqual(video.actions_count, 3)
+        self.assertIsNone(Video.objects.get(remote_id=2).album)
+
+    def test_fetch_videos_fingerprint(self):
+        owner = GroupFactory(remote_id=GROUP_ID)
+        resources = [video_resource(i, -GROUP_ID) for i in range(1, 4)]
+
+        def fetch(**kwargs):
+            with mock.patch('vkontakte_video.models.VideoRemoteManager.api_call', return_value=resources):
+                return Video.remote.fetch(owner=owner, bulk=True, **kwargs)
+
+        fetch()
+        fingerprint = Video.objects.get(remote_id=1).fingerprint
+        self.assertEqual(len(fingerprint), 32)
+        fetched = Video.objects.get(remote_id=1).fetched
+
+        # unchanged videos aren't updated at all
+        resources[1] = video_resource(2, -GROUP_ID, views=20)
+        fetch()
+        self.assertEqual(Video.objects.get(remote_id=1).fingerprint, fingerprint)
+        self.assertEqual(Video.objects.get(remote_id=1).fetched, fetched)
+        self.assertEqual(Video.objects.get(remote_id=2).views_count, 20)
+
+        # with `touch` unchanged videos get only new `fetched`
+        fetch(touch=True)
+        self.assertEqual(Video.objects.get(remote_id=1).fingerprint, fingerprint)
+        self.assertGreater(Video.objects.get(remote_id=1).fetched, fetched)
+
+    def test_video_querysets(self):
+        owner = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=owner)
+        now = timezone.now()
+        for i in range(1, 4):
+            VideoFactory(remote_id=i, owner=owner, album=album if i < 3 else None, views_count=i * 10,
+                         date=now - timedelta(days=i))
+        VideoFactory(remote_id=4, owner=UserFactory(remote_id=USER_ID), album=None, views_count=100)
+
+        self.assertEqual([video.pk for video in Video.objects.for_owner(owner)], [1, 2, 3])
+        self.assertEqual([video.pk for video in Video.objects.in_album(album)], [1, 2])
+        self.assertEqual([video.pk for video in Video.objects.top_viewed()[:2]], [4, 3])
+        self.assertEqual([video.pk for video in Video.objects.for_owner(owner).top_viewed()], [3, 2, 1])
+
+        # heavy fields are deferred
+        video = Video.objects.for_owner(owner)[0]
+        self.assertNotIn('description', video.__dict__)
+        self.assertIn('description', Video.objects.for_owner(owner, full=True)[0].__dict__)
+
+    def test_admin_helpers(self):
+        album = AlbumFactory()
+        for i in range(3):
+            VideoFactory(album=album)
+
+        self.assertEqual(ApproximateCountPaginator(Video.objects.all(), 2).count, 3)
+
+        LimitedInlineFormSet.limit = 2
+        try:
+            FormSet = inlineformset_factory(Album, Video, formset=LimitedInlineFormSet, fields=('title',), extra=0)
+            self.assertEqual(len(FormSet(instance=album).forms), 2)
+        finally:
+            LimitedInlineFormSet.limit = 100
+
+    def test_queries_counter(self):
+        queries = len(connection.queries)
+        with QueriesCounter() as counter:
+            list(Album.objects.all())
+            list(Video.objects.all())
+
+        self.assertEqual(counter.count, 2)
+        # queries, logged for counting, don't accumulate in connection
+        self.assertEqual(len(connection.queries), queries)
+
+    def test_export(self):
+        owner = GroupFactory(remote_id=GROUP_ID)
+        album = AlbumFactory(remote_id=ALBUM_ID, owner=owner)
+        for i in range(1, 6):
+            VideoFactory(remote_id=i, owner=owner, album=album, views_count=i)
+
+        records = list(iter_videos(chunk_size=2))
+        self.assertEqual([record.remote_id for record in records], [1, 2, 3, 4, 5])
+        self.assertEqual(records[0].owner_remote_id, -GROUP_ID)
+        self.assertEqual(records[0].url, 'http://vk.com/video-%s_1' % GROUP_ID)
+        self.assertEqual(list(iter_albums())[0].slug, 'videos-%s?section=album_%s' % (GROUP_ID, ALBUM_ID))
+
+        output = StringIO()
+        export(iter_videos(chunk_size=2), output, 'csv')
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith('remote_id,owner_id,album_id,title'))
+
+        output = StringIO()
+        export(iter_videos(), output, 'jsonl', fields=('remote_id', 'views_count'))
+        self.assertEqual(json.loads(output.getvalue().splitlines()[-1]), {'remote_id': 5, 'views_count': 5})
+
+        output = StringIO()
+        export(iter_videos(), output, 'columns', fields=('remote_id',), chunk_size=2)
+        self.assertEqual([json.loads(line)['remote_id'] for line in output.getvalue().splitlines()],
+                         [[1, 2], [3, 4], [5]])
+
+        output = StringIO()
+        export(iter_videos(Video.objects.none()), output, 'csv')
+        self.assertEqual(output.getvalue(), '')
+
     def test_parse_video(self):
 
         owner = GroupFactory(remote_id=GROUP_ID)
@@ -314,3 +467,553 @@ class VkontakteVideosTest(TestCase):
 
         self.assertEqual(album.get_url().count("-"), 0)
         self.assertEqual(video.get_url().count("-"), 0)
+
+
+class VkontakteVideosSyncTest(TestCase):
+
+    def setUp(self):
+        owner_cache.clear()
+        self.owners = [GroupFactory(remote_id=GROUP_ID), GroupFactory(remote_id=GROUP_CRUD_ID)]
+        self.api = fake_api_of(self.owners)
+
+    def test_sync_owners(self):
+        with self.api.patch():
+            report = sync_owners(self.owners, rate_limiter=TokenBucket(1000))
+
+        self.assertEqual(len(report), 2)
+        self.assertEqual(len(report.failed), 0)
+        self.assertEqual(report.albums, 4)
+        self.assertEqual(report.videos, 12)
+        self.assertEqual(Album.objects.count(), 4)
+        self.assertEqual(Video.objects.count(), 12)
+        self.assertEqual(Video.objects.filter(album__remote_id=GROUP_ID + 1).count(), 3)
+
+    def test_sync_owners_errors(self):
+        with self.api.patch():
+            with mock.patch.object(Album, 'fetch_videos', side_effect=ValueError('Broken album')):
+                report = sync_owners(self.owners, rate_limiter=TokenBucket(1000))
+
+        self.assertEqual(len(report.failed), 2)
+        self.assertIsInstance(report.failed[0].error, ValueError)
+        self.assertEqual(Album.objects.count(), 4)
+
+    def test_sync_command(self):
+        out, err = StringIO(), StringIO()
+        with self.api.patch():
+            call_command('vkontakte_video_sync', str(-GROUP_ID), str(-GROUP_CRUD_ID), mode='full', rate=1000,
+                         stdout=out, stderr=err)
+
+        summary = json.loads(out.getvalue())
+        self.assertEqual((summary['owners'], summary['succeeded'], summary['failed']), (2, 2, []))
+        self.assertEqual((summary['albums'], summary['videos']), (4, 12))
+        self.assertEqual(summary['requests'], len(self.api.calls))
+        self.assertEqual(len(err.getvalue().strip().split('\n')), 2)
+        self.assertIn('[2/2]', err.getvalue())
+
+        out = StringIO()
+        with self.api.patch(), mock.patch.object(Album, 'fetch_videos', side_effect=ValueError('Broken album')):
+            self.assertRaises(CommandError, call_command, 'vkontakte_video_sync', str(-GROUP_ID), rate=1000,
+                              stdout=out, stderr=StringIO())
+        self.assertEqual(json.loads(out.getvalue())['failed'][0]['owner_id'], -GROUP_ID)
+
+    def test_run_schedule(self):
+        for owner in self.owners:
+            OwnerSchedule.objects.add(owner)
+
+        with self.api.patch():
+            report = run_schedule(rate_limiter=TokenBucket(1000), once=True)
+
+        self.assertEqual(len(report), 2)
+        self.assertEqual(report.videos, 12)
+        self.assertEqual(OwnerSchedule.objects.due().count(), 0)
+
+        # owner without recent videos backs off exponentially
+        schedule = OwnerSchedule.objects.get(owner_id=self.owners[0].pk)
+        self.assertEqual(schedule.velocity, 0)
+        self.assertEqual(schedule.interval, 7200)
+
+        # the second synchronization finds nothing new
+        OwnerSchedule.objects.update(next_due=timezone.now())
+        with self.api.patch():
+            report = run_schedule(rate_limiter=TokenBucket(1000), once=True)
+        self.assertEqual(len(report), 2)
+        self.assertEqual(report.videos, 0)
+        schedule = OwnerSchedule.objects.get(pk=schedule.pk)
+        self.assertEqual(schedule.interval, 14400)
+
+        # active owner is polled according to its velocity
+        now = timezone.now()
+        for i in range(30):
+            VideoFactory(owner=self.owners[0], date=now - timedelta(days=i))
+        schedule.reschedule(1, now=now)
+        self.assertEqual(schedule.velocity, 1)
+        self.assertEqual(schedule.interval, 86400)
+        self.assertEqual(schedule.next_due, now + timedelta(days=1))
+
+        # failed synchronization is retried with backoff, interval is kept
+        schedule.reschedule(failed=True, now=now)
+        schedule.reschedule(failed=True, now=now)
+        self.assertEqual(schedule.failures, 2)
+        self.assertEqual(schedule.interval, 86400)
+        self.assertEqual(schedule.next_due, now + timedelta(seconds=7200))
+
+        # active owner without new videos backs off too
+        schedule.reschedule(0, now=now)
+        self.assertEqual(schedule.interval, 172800)
+
+    def test_schedule_leases(self):
+        for owner in self.owners:
+            OwnerSchedule.objects.add(owner)
+        now = timezone.now()
+
+        claimed = list(OwnerSchedule.objects.claim('worker1', limit=1, lease=60, now=now))
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claimed[0].leased_by, 'worker1')
+        self.assertEqual([schedule.leased_by for schedule in OwnerSchedule.objects.claim('worker2', now=now)],
+                         ['worker2'])
+        self.assertEqual(OwnerSchedule.objects.claim('worker3', now=now).count(), 0)
+        self.assertEqual(OwnerSchedule.objects.due(now).count(), 0)
+        # idle worker waits for the nearest expiration of lease, not for due owners leased by others
+        nearest = OwnerSchedule.objects.nearest(now)
+        self.assertTrue(now + timedelta(seconds=59) < nearest <= now + timedelta(seconds=60))
+
+        # expired lease is claimed by other worker and isn't prolonged by the old one
+        later = now + timedelta(seconds=61)
+        self.assertEqual([schedule.pk for schedule in OwnerSchedule.objects.claim('worker3', now=later)],
+                         [claimed[0].pk])
+        self.assertEqual(OwnerSchedule.objects.heartbeat('worker1', [claimed[0].pk]), 0)
+        self.assertEqual(OwnerSchedule.objects.heartbeat('worker3', [claimed[0].pk]), 1)
+
+        # worker, which lost the lease, doesn't reschedule owner
+        schedule = OwnerSchedule.objects.get(pk=claimed[0].pk)
+        self.assertFalse(schedule.reschedule(0, now=later, worker='worker1'))
+        self.assertEqual(OwnerSchedule.objects.get(pk=schedule.pk).leased_by, 'worker3')
+
+        # rescheduling releases lease
+        schedule = OwnerSchedule.objects.get(pk=claimed[0].pk)
+        self.assertTrue(schedule.reschedule(0, now=later, worker='worker3'))
+        self.assertEqual(OwnerSchedule.objects.get(pk=schedule.pk).leased_by, '')
+        self.assertIsNone(OwnerSchedule.objects.get(pk=schedule.pk).lease_expires)
+        self.assertGreater(OwnerSchedule.objects.get(pk=schedule.pk).next_due, later)
+
+    def test_trim_response(self):
+        resource = video_resource(1, -GROUP_ID, photo_320='http://cs313422.vk.me/u163668241/video/l_4cc8a38a.jpg',
+                                  repeat=0, can_repost=1)
+        response = {'count': 1, 'items': [resource], 'profiles': [{'id': USER_ID}], 'groups': [{'id': GROUP_ID}]}
+
+        with mock.patch('vkontakte_video.mixins.api_call', side_effect=lambda *args, **kw: deepcopy(response)):
+            trimmed = Video.remote.api_response('get', owner_id=-GROUP_ID, extended=1)
+            videos = Video.remote.fetch(owner=self.owners[0])
+
+        self.assertEqual(sorted(trimmed.keys()), ['count', 'items'])
+        self.assertEqual(sorted(trimmed['items'][0].keys()), sorted(set(VIDEO_RESPONSE_FIELDS) & set(resource.keys())))
+        self.assertEqual(videos[0].title, 'Video 1')
+        self.assertEqual(videos[0].likes_count, 2)
+
+    def test_token_bucket(self):
+        clock = mock.Mock(return_value=0)
+        sleep = mock.Mock(side_effect=lambda seconds: clock.configure_mock(return_value=clock() + seconds))
+
+        bucket = TokenBucket(2, clock=clock, sleep=sleep)
+        for i in range(4):
+            bucket.acquire()
+
+        # 2 tokens were available at once, 2 others in 1 second
+        self.assertEqual(clock(), 1)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_fetch_albums_videos(self):
+        owner = self.owners[0]
+        albums = [AlbumFactory(remote_id=GROUP_ID + 1, owner=owner, videos_count=0)]
+        for album_id in range(100, 130):
+            self.api.add_album(-GROUP_ID, album_id)
+            self.api.add_video(-GROUP_ID, album_id * 1000, album_id=album_id)
+            albums += [AlbumFactory(remote_id=album_id, owner=owner, videos_count=0)]
+
+        with self.api.patch():
+            videos = Video.remote.fetch_albums_videos(albums, count=2)
+
+        # 31 albums + 1 extra page of the first album in 2 requests
+        self.assertEqual([method for method, kwargs in self.api.calls], ['execute', 'execute'])
+        self.assertEqual(videos.count(), 33)
+        self.assertEqual(Video.objects.filter(album=albums[0]).count(), 3)
+        self.assertEqual(Video.objects.get(remote_id=100000).album, albums[1])
+        self.assertEqual(Album.objects.get(pk=GROUP_ID + 1).videos_count, 3)
+
+    def test_fetch_incremental(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, incremental=True)
+
+        self.assertEqual(videos.count(), 6)
+        state = VideoSyncState.objects.get(owner_id=owner.pk, album=None)
+        self.assertEqual(state.video_remote_id, GROUP_ID + 11)
+
+        # new video at the top of the list
+        self.api.videos[-GROUP_ID].insert(0, video_resource(GROUP_ID + 100, -GROUP_ID, date=FAKE_DATE))
+        self.api.calls = []
+
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, incremental=True)
+
+        self.assertEqual(len(self.api.calls), 2)
+        self.assertEqual([video.remote_id for video in videos], [GROUP_ID + 100])
+        self.assertEqual(Video.objects.count(), 7)
+        state = VideoSyncState.objects.get(pk=state.pk)
+        self.assertEqual(state.video_remote_id, GROUP_ID + 100)
+
+        # nothing new, the newest known video isn't counted
+        with self.api.patch():
+            self.assertEqual(Video.remote.fetch(owner=owner, incremental=True).count(), 0)
+
+    def test_fetch_by_ids(self):
+        owner, other = self.owners
+        with self.api.patch():
+            Album.remote.fetch(owner=owner)
+
+        ids = [(-GROUP_ID, GROUP_ID + 11), '-%d_%d' % (GROUP_ID, GROUP_ID + 21), (-GROUP_CRUD_ID, GROUP_CRUD_ID + 12),
+               '-%d_%d' % (GROUP_ID, GROUP_ID + 11)]
+        with self.api.patch(), mock.patch('vkontakte_video.models.VIDEOS_IDS_LIMIT', 2):
+            videos = Video.remote.fetch_by_ids(ids, workers=2, bulk=True)
+
+        self.assertEqual(videos.count(), 3)
+        self.assertEqual(sorted([len(kwargs['videos'].split(',')) for method, kwargs in self.api.calls[1:]]), [1, 2])
+        # albums are taken from response, if they exist locally
+        self.assertEqual(Video.objects.get(pk=GROUP_ID + 21).album_id, GROUP_ID + 2)
+        self.assertIsNone(Video.objects.get(pk=GROUP_CRUD_ID + 12).album_id)
+        self.assertEqual(Video.objects.get(pk=GROUP_CRUD_ID + 12).owner, other)
+
+    def test_fetch_resumable(self):
+        owner = self.owners[0]
+        api_call = self.api
+
+        def failing_call(method, **kwargs):
+            if kwargs.get('offset') == 4:
+                raise ValueError('Rate limit')
+            return api_call(method, **kwargs)
+
+        with mock.patch('vkontakte_video.mixins.api_call', new=failing_call):
+            self.assertRaises(ValueError, Video.remote.fetch, owner=owner, resumable=True, page_size=2)
+
+        # two pages are saved before failure
+        self.assertEqual(Video.objects.count(), 4)
+        state = VideoSyncState.objects.get(owner_id=owner.pk, album=None)
+        self.assertEqual((state.crawl_offset, state.crawl_count), (4, 6))
+
+        # the first video is deleted, so the crawl rereads one video before the checkpoint
+        self.api.videos[-GROUP_ID].pop(0)
+        self.api.calls = []
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, all=True, resumable=True, page_size=2)
+
+        self.assertEqual([kwargs['offset'] for method, kwargs in self.api.calls], [4, 3])
+        self.assertEqual(Video.objects.count(), 6)
+        self.assertEqual(videos.count(), 6)
+        state = VideoSyncState.objects.get(pk=state.pk)
+        self.assertEqual((state.crawl_started, state.crawl_offset, state.crawl_count), (None, 0, None))
+
+    def test_iter_fetch(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            pages = Video.remote.iter_fetch(owner=owner, page_size=4, batches=True)
+
+            videos = next(pages)
+            self.assertEqual(len(videos), 4)
+            self.assertEqual(Video.objects.count(), 4)
+
+            videos = next(pages)
+            self.assertEqual(len(videos), 2)
+            self.assertEqual(Video.objects.count(), 6)
+
+            self.assertRaises(StopIteration, next, pages)
+
+        with self.api.patch():
+            videos = list(Video.remote.iter_fetch(owner=owner, page_size=4))
+
+        self.assertEqual(len(videos), 6)
+        self.assertEqual(videos[0].remote_id, GROUP_ID + 11)
+
+    def test_fetch_parallel_pages(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, count=2, parallel_pages=2)
+            albums = Album.remote.fetch(owner=owner, count=1, parallel_pages=2)
+
+        self.assertEqual(len(self.api.calls), 5)
+        self.assertEqual(sorted([kwargs.get('offset', 0) for method, kwargs in self.api.calls[:3]]), [0, 2, 4])
+        self.assertEqual(videos.count(), 6)
+        self.assertEqual(Video.objects.count(), 6)
+        self.assertEqual(albums.count(), 2)
+
+    def test_fetch_all_parallel_pages(self):
+        owner = self.owners[0]
+        # the second video shifted to the next page while requesting
+        self.api.videos[-GROUP_ID].insert(2, dict(self.api.videos[-GROUP_ID][1]))
+
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, all=True, count=2, parallel_pages=3)
+
+        self.assertEqual(videos.count(), 6)
+        self.assertEqual(Video.objects.count(), 6)
+        self.assertEqual(sorted([kwargs.get('offset', 0) for method, kwargs in self.api.calls[:4]]), [0, 2, 4, 6])
+
+    def test_video_refresh_queue(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            Video.remote.fetch(owner=owner)
+        self.assertEqual(VideoRefresh.objects.count(), 0)
+
+        self.api.videos[-GROUP_ID][1]['comments'] = 5
+        self.api.videos[-GROUP_ID][2]['views'] = 100
+
+        with self.settings(VKONTAKTE_VIDEO_REFRESH_QUEUE=True):
+            with self.api.patch():
+                Video.remote.fetch(owner=owner)
+
+        # only changes of comments or likes are refreshed
+        self.assertEqual(VideoRefresh.objects.count(), 1)
+        refresh = VideoRefresh.objects.get()
+        self.assertEqual(refresh.video.remote_id, self.api.videos[-GROUP_ID][1]['id'])
+        self.assertEqual(refresh.comments_count, 4)
+        self.assertTrue(refresh.comments)
+        self.assertFalse(refresh.likes)
+        self.assertGreater(refresh.priority, 0)
+
+        # failed refresh stays in the queue with lower priority
+        with mock.patch.object(Video, 'fetch_comments', side_effect=Exception):
+            self.assertEqual(VideoRefresh.objects.process(), 0)
+        failed = VideoRefresh.objects.get()
+        self.assertEqual(failed.attempts, 1)
+        self.assertAlmostEqual(failed.priority, refresh.priority / 2)
+
+        with mock.patch.object(Video, 'fetch_comments') as fetch_comments:
+            with mock.patch.object(Video, 'fetch_likes') as fetch_likes:
+                self.assertEqual(VideoRefresh.objects.process(), 1)
+
+        self.assertEqual(fetch_comments.call_count, 1)
+        self.assertEqual(fetch_likes.call_count, 0)
+        self.assertEqual(VideoRefresh.objects.count(), 0)
+
+    def test_response_cache(self):
+        owner = self.owners[0]
+        cache = MemoryResponseCache()
+
+        with self.api.patch():
+            Album.remote.fetch(owner=owner, response_cache=cache)
+            Video.remote.fetch(owner=owner, response_cache=cache)
+            albums = Album.remote.fetch(owner=owner, response_cache=cache)
+            videos = Video.remote.fetch(owner=owner, response_cache=cache)
+            Video.remote.fetch(owner=owner, offset=2, response_cache=cache)
+
+        self.assertEqual(len(self.api.calls), 3)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        self.assertEqual(albums.count(), 2)
+        self.assertEqual(videos.count(), 6)
+
+    @override_settings(VKONTAKTE_VIDEO_FETCH_STATS=True, VKONTAKTE_VIDEO_FETCH_PROFILE=True)
+    def test_fetch_stats(self):
+        owner = self.owners[0]
+        handler = mock.Mock()
+        vkontakte_video_fetch_stats.connect(handler)
+
+        with self.api.patch():
+            Album.remote.fetch(owner=owner)
+            Video.remote.fetch(owner=owner, all=True, count=2, parallel_pages=2)
+        vkontakte_video_fetch_stats.disconnect(handler)
+
+        # nested fetches of all pages are accounted in one statistics
+        self.assertEqual(handler.call_count, 2)
+        albums, videos = [call[1]['stats'] for call in handler.call_args_list]
+
+        self.assertEqual(albums.name, 'Album.fetch')
+        self.assertEqual(albums.owner_id, -GROUP_ID)
+        self.assertEqual(albums.pages, 1)
+        self.assertGreater(albums.queries, 0)
+
+        # 3 pages in parallel and the last empty page
+        self.assertEqual(videos.pages, 4)
+        self.assertGreater(videos.bytes, 0)
+        self.assertEqual(set(videos.phases), set(['request', 'parse', 'owner', 'save']))
+        self.assertIsNotNone(videos.profile)
+        self.assertEqual(json.loads(json.dumps(videos.as_dict()))['owner_id'], -GROUP_ID)
+
+    def test_owner_cache(self):
+        owner = self.owners[0]
+        resources = [video_resource(i, -GROUP_ID) for i in range(1, 6)]
+
+        videos = Video.remote.parse_response([dict(resource) for resource in resources])
+        self.assertEqual(set([video.owner_id for video in videos]), set([owner.pk]))
+
+        # resolved owner is reused by the next parses without queries
+        with self.assertNumQueries(0):
+            Video.remote.parse_response([dict(resource) for resource in resources])
+
+        # fetch primes the cache with the owner
+        owner_cache.clear()
+        with self.api.patch():
+            Album.remote.fetch(owner=owner)
+        self.assertEqual(owner_cache.get(-GROUP_ID), owner)
+
+        owner.delete()
+        self.assertEqual(len(owner_cache), 0)
+
+    def test_reconcile_albums(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            self.assertEqual(len(Album.remote.reconcile(owner)), 2)
+        self.assertEqual(Video.objects.filter(owner_id=owner.pk).count(), 6)
+
+        # nothing changed, only albums are requested: the page and the last empty page of fetch_all
+        self.api.calls = []
+        with self.api.patch():
+            self.assertEqual(Album.remote.reconcile(owner), [])
+        self.assertEqual([method for method, kwargs in self.api.calls], ['video.getAlbums'] * 2)
+
+        # new video in the first album
+        self.api.videos[-GROUP_ID].insert(0, video_resource(GROUP_ID + 100, -GROUP_ID, album_id=GROUP_ID + 1,
+                                                            date=FAKE_DATE + 10))
+        with self.api.patch():
+            self.assertEqual([album.pk for album in Album.remote.reconcile(owner)], [GROUP_ID + 1])
+        self.assertTrue(Video.objects.filter(pk=GROUP_ID + 100, album_id=GROUP_ID + 1).exists())
+        self.assertEqual(Album.objects.get(pk=GROUP_ID + 1).videos_count, 4)
+
+        # deleted video of the second album decreases videos_count
+        self.api.videos[-GROUP_ID] = [video for video in self.api.videos[-GROUP_ID] if video['id'] != GROUP_ID + 21]
+        with self.api.patch():
+            self.assertEqual([album.pk for album in Album.remote.reconcile(owner)], [GROUP_ID + 2])
+        self.assertEqual(Album.objects.get(pk=GROUP_ID + 2).videos_count, 2)
+
+        # old video, added to the first album later, is older than the newest known one
+        self.api.videos[-GROUP_ID].append(video_resource(GROUP_ID + 101, -GROUP_ID, album_id=GROUP_ID + 1,
+                                                         date=FAKE_DATE - 1000))
+        with self.api.patch():
+            self.assertEqual([album.pk for album in Album.remote.reconcile(owner)], [GROUP_ID + 1])
+        self.assertTrue(Video.objects.filter(pk=GROUP_ID + 101, album_id=GROUP_ID + 1).exists())
+        self.assertEqual(Album.objects.get(pk=GROUP_ID + 1).videos.count(), 5)
+
+    def test_fetch_sweep(self):
+        owner = self.owners[0]
+        stale = VideoFactory(remote_id=1, owner=owner, album=None)
+        other = VideoFactory(remote_id=2, owner=self.owners[1], album=None)
+
+        with self.api.patch():
+            videos = Video.remote.fetch(owner=owner, all=True, sweep=True, page_size=4)
+
+        self.assertEqual(videos.count(), 6)
+        self.assertEqual(list(Video.objects.filter(archived=True).values_list('pk', flat=True)), [stale.pk])
+        self.assertFalse(Video.objects.get(pk=other.pk).archived)
+
+        # removed video is archived, but not deleted
+        removed = self.api.videos[-GROUP_ID].pop(0)
+        Video.objects.filter(pk=removed['id']).update(fetched=timezone.now() - timedelta(days=1))
+        with self.api.patch():
+            Video.remote.fetch(owner=owner, sweep=True)
+        self.assertTrue(Video.objects.get(pk=removed['id']).archived)
+        self.assertEqual(Video.objects.filter(owner_id=owner.pk, archived=False).count(), 5)
+
+        # video appeared again
+        self.api.videos[-GROUP_ID].insert(0, removed)
+        with self.api.patch():
+            Video.remote.fetch(owner=owner, sweep=True, bulk=True)
+        self.assertFalse(Video.objects.get(pk=removed['id']).archived)
+
+        self.assertRaises(ValueError, Video.remote.fetch, owner=owner, sweep=True, after=timezone.now())
+
+    @override_settings(VKONTAKTE_VIDEO_STATISTICS=True)
+    def test_video_statistics(self):
+        owner = self.owners[0]
+
+        with self.api.patch():
+            Video.remote.fetch(owner=owner)
+            Video.remote.fetch(owner=owner, bulk=True)
+        # the second fetch didn't change counters
+        self.assertEqual(VideoStatistic.objects.count(), 6)
+
+        self.api.videos[-GROUP_ID][0]['views'] = 100
+        with self.api.patch():
+            Video.remote.fetch(owner=owner, bulk=True)
+        self.assertEqual(VideoStatistic.objects.count(), 7)
+        video_id = self.api.videos[-GROUP_ID][0]['id']
+        self.assertEqual(VideoStatistic.objects.filter(video_id=video_id).latest().views_count, 100)
+
+        # the last sample of every day is kept, samples are read by chunks of 2 samples
+        times = [datetime(2014, 1, 1, 10), datetime(2014, 1, 1, 12), datetime(2014, 1, 2, 10)]
+        VideoStatistic.objects.bulk_create([VideoStatistic(video_id=video_id, time=time.replace(tzinfo=timezone.utc))
+                                            for time in times])
+        self.assertEqual(VideoStatistic.objects.downsample(before=timezone.now() - timedelta(hours=1),
+                                                           chunk_size=2), 1)
+        self.assertEqual(VideoStatistic.objects.purge(before=datetime(2014, 1, 3, tzinfo=timezone.utc)), 2)
+        self.assertEqual(VideoStatistic.objects.count(), 7)
+
+    def test_response_cache_eviction(self):
+        clock = mock.Mock(return_value=0)
+        cache = MemoryResponseCache(timeout=10, max_entries=2, clock=clock)
+
+        for offset in range(3):
+            cache.set(cache.make_key('video.get', {'offset': offset}), {'offset': offset})
+
+        # the least recently used response is evicted
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(cache.make_key('video.get', {'offset': 0})))
+        self.assertEqual(cache.get(cache.make_key('video.get', {'offset': 1})), {'offset': 1})
+
+        # expired response
+        clock.return_value = 11
+        self.assertIsNone(cache.get(cache.make_key('video.get', {'offset': 1})))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_benchmark(self):
+        results = run_benchmark(30, albums=3, bulk=True)
+
+        self.assertEqual([result['pass'] for result in results], ['initial', 'resync'])
+        self.assertEqual(results[0]['videos'], 30)
+        self.assertEqual(results[0]['requests'], 2)
+        self.assertGreater(results[0]['queries_per_video'], 0)
+        self.assertGreater(results[1]['diff'], 0)
+        # changes are rolled back
+        self.assertEqual(Video.objects.count(), 0)
+
+        out = StringIO()
+        call_command('vkontakte_video_benchmark', sizes='10', albums=2, scenario='albums', stdout=out)
+        self.assertEqual(len(out.getvalue().strip().split('\n')), 5)
+
+
+class VkontakteVideosThreadsTest(TransactionTestCase):
+
+    '''
+    Worker threads use own connections to DB, so data of tests should be committed
+    '''
+
+    def setUp(self):
+        owner_cache.clear()
+
+    def test_api_call_per_thread(self):
+        apis = []
+        with mock.patch('vkontakte_video.api.VkontakteApi.call', autospec=True,
+                        side_effect=lambda api, *args, **kwargs: apis.append(id(api))):
+            threads = [threading.Thread(target=api_call, args=('video.get',)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(set(apis)), 2)
+
+    @skipIf(connection.vendor == 'sqlite', 'in-memory SQLite database is not shared between threads')
+    def test_sync_owners_workers(self):
+        owners = [GroupFactory(remote_id=GROUP_ID), GroupFactory(remote_id=GROUP_CRUD_ID)]
+        api = fake_api_of(owners)
+
+        with api.patch():
+            report = sync_owners(owners, workers=2, rate_limiter=TokenBucket(1000))
+
+        self.assertEqual(len(report.failed), 0)
+        self.assertEqual(report.albums, 4)
+        self.assertEqual(report.videos, 12)
+        self.assertEqual(Video.objects.count(), 12)
+        self.assertEqual(report.requests, len(api.calls))
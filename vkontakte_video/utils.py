@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+
+class TokenBucket(object):
+
+    '''
+    Thread-safe token bucket rate limiter.
+    Allows `rate` calls of acquire() per second on average with bursts up to `capacity` calls.
+    One instance should be shared between all threads, using the same access token
+    '''
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("Argument `rate` should be positive number")
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        Take `tokens` from the bucket, sleeping until they are available
+        '''
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            self.sleep(wait)
+
+
+class QueriesCounter(object):
+
+    '''
+    Context manager, counting SQL queries of default DB connection even with DEBUG = False.
+    Queries, logged only for counting, are removed from `connection.queries` after the block,
+    because it's cleared only on start of request and would grow forever in long-running workers
+    '''
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        self.count = 0
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.use_debug_cursor
+        if not (self.use_debug_cursor or settings.DEBUG):
+            del connection.queries[self.start:]
+
+
+class OwnerCache(object):
+
+    '''
+    Thread-safe cache of owners (groups and users) by signed remote id, the same as `owner_id` in responses.
+    Content types of owners are cached by ContentTypeManager, so assigning of cached owner makes no queries.
+    Owners should be removed with discard() or clear(), when their rows are deleted
+    '''
+
+    def __init__(self):
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.owners)
+
+    def get(self, remote_id):
+        with self.lock:
+            owner = self.owners.get(remote_id)
+        if owner is None:
+            owner = self.resolve(remote_id)
+            self.set(remote_id, owner)
+        return owner
+
+    def resolve(self, remote_id):
+        from vkontakte_groups.models import Group
+        from vkontakte_users.models import User
+
+        if remote_id > 0:
+            Model = User
+        elif remote_id < 0:
+            Model = Group
+        else:
+            raise ValueError("remote_id shouldn't be equal to 0")
+
+        return Model.objects.get_or_create(remote_id=abs(remote_id))[0]
+
+    def set(self, remote_id, owner):
+        with self.lock:
+            self.owners[remote_id] = owner
+
+    def discard(self, remote_id):
+        with self.lock:
+            self.owners.pop(remote_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.owners.clear()
+
+
+owner_cache = OwnerCache()
+
+
+def get_approximate_count(queryset, threshold=100000):
+    '''
+    Return number of rows of unfiltered queryset from statistics of PostgreSQL table instead of slow COUNT(*),
+    if the table has more than `threshold` rows. In other cases returns exact count
+    '''
+    if connection.vendor == 'postgresql' and not queryset.query.where:
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] > threshold:
+            return int(row[0])
+    return queryset.count()